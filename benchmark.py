@@ -0,0 +1,124 @@
+import argparse
+import copy
+import itertools
+import json
+import os
+import time
+import tracemalloc
+import model
+
+
+def calorimeter(layers, cells):
+    '''Calorimeter of layers pairs of lead and scintillator, as in simulator.py.'''
+    passive = model.Layer('lead', 1, 1, 1.0, 1, 0.0)
+    active = model.Layer('scin', 0.01, 1, 32, cells, 1.0)
+    cal = model.Calorimeter()
+    for i in range(layers):
+        cal.add_layers([passive, active])
+    return cal
+
+
+geometries = {'30x32': (30, 32), '10x16': (10, 16)}
+energies = [0.1, 2.0, 10.0, 40.0]
+engines = list(model.Simulation.ENGINES)
+run_counts = [1, 10]
+sigma = 0.3
+baseline_file = 'benchmark_baseline.json'
+tolerance = 0.2
+
+
+def time_step(cal, repeat=3, steps=200000):
+    '''Particles stepped per second by Calorimeter.step for an electron that is put back to
+    the front of the calorimeter whenever it leaves and never interacts, best of repeat.'''
+    best = 0.0
+    for r in range(repeat):
+        cal.reset()
+        particle = model.Electron(0.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+        particle.interact = lambda std, pool=None: [particle]
+        tic = time.perf_counter()
+        for i in range(steps):
+            cal.step(particle, sigma, 0.1)
+            if particle.z >= cal._zend:
+                particle.z = 0.0
+        best = max(best, steps/(time.perf_counter() - tic))
+    return best
+
+
+def time_simulate(cal, engine, energy, num_runs, repeat=3):
+    '''Events and particle steps per second of Simulation.simulate, best of repeat, and the
+    peak memory in MB of one more call traced separately, so tracing doesn't slow the timing.
+    The particle steps are those of Simulation.particle_steps, the same work for every
+    engine.'''
+    sim = model.Simulation(copy.deepcopy(cal), engine=engine)
+    particle = model.Electron(0.0, 0, 0, energy, 0, 0)
+    # Warm up, this also compiles the kernel of the compiled engine
+    sim.simulate(particle, sigma, 1, seed=0)
+    events, steps = 0.0, 0.0
+    for r in range(repeat):
+        tic = time.perf_counter()
+        sim.simulate(particle, sigma, num_runs, seed=r)
+        elapsed = time.perf_counter() - tic
+        events = max(events, num_runs/elapsed)
+        steps = max(steps, sim.particle_steps.sum()/elapsed)
+    tracemalloc.start()
+    sim.simulate(particle, sigma, num_runs, seed=0)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'events_per_second': events, 'particle_steps_per_second': float(steps),
+            'peak_memory_mb': peak/2**20}
+
+
+def run(repeat=3):
+    '''Run all benchmarks, returns a dictionary with the results of each case.'''
+    results = {}
+    for name, (layers, cells) in geometries.items():
+        cal = calorimeter(layers, cells)
+        results[f'step/{name}'] = {'particles_per_second': time_step(cal, repeat)}
+        print(f'{"step/" + name:30} {results[f"step/{name}"]["particles_per_second"]:14.0f} steps/s')
+        for engine, energy, num_runs in itertools.product(engines, energies, run_counts):
+            key = f'simulate/{name}/{engine}/{energy:.1f}GeV/{num_runs}runs'
+            results[key] = time_simulate(cal, engine, energy, num_runs, repeat)
+            r = results[key]
+            print(f'{key:50} {r["events_per_second"]:10.2f} events/s '
+                  f'{r["particle_steps_per_second"]:12.0f} particle steps/s {r["peak_memory_mb"]:8.1f} MB')
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''List the cases where a rate dropped or the peak memory grew by more than the fraction
+    tolerance compared to the baseline.'''
+    regressions = []
+    for key, values in results.items():
+        for quantity, value in values.items():
+            old = baseline.get(key, {}).get(quantity)
+            if old is None or old <= 0:
+                continue
+            change = value/old - 1.0
+            worse = change > tolerance if quantity == 'peak_memory_mb' else change < -tolerance
+            if worse:
+                regressions.append(f'{key} {quantity}: {old:.4g} -> {value:.4g} ({100*change:+.0f}%)')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the simulation and compare with a baseline')
+    parser.add_argument('--baseline', default=baseline_file)
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=tolerance)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    if args.save or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print(f'* Baseline written to {args.baseline} *')
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION ' + line)
+        print(f'* {len(regressions)} regressions beyond {100*args.tolerance:.0f}% *')
+        if regressions:
+            raise SystemExit(1)
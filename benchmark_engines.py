@@ -0,0 +1,27 @@
+import time
+import model
+
+# Same calorimeter as simulator.py
+passive = model.Layer('lead', 1, 1, 1.0, 1, 0.0)
+active = model.Layer('scin', 0.01, 1, 32, 32, 1.0)
+mycal = model.Calorimeter()
+for i in range(30):
+    mycal.add_layers([passive, active])
+
+energies = [0.1, 2.0, 10.0, 20.0, 40.0]
+engines = ['step', 'compiled']
+sigma = 0.3; num_runs = 5
+
+if __name__ == '__main__':
+    sims = {engine: model.Simulation(mycal, engine=engine) for engine in engines}
+    # Compile the kernel before timing
+    sims['compiled'].simulate(model.Electron(0.0, 0, 0, 0.1, 0, 0), sigma, 1)
+
+    print(f'{"energy":>8}' + ''.join(f'{e + " [s]":>16}' for e in engines) + f'{"speedup":>10}')
+    for energy in energies:
+        times = []
+        for engine in engines:
+            tic = time.time()
+            sims[engine].simulate(model.Electron(0.0, 0, 0, energy, 0, 0), sigma, num_runs, seed=1)
+            times.append(time.time() - tic)
+        print(f'{energy:8.1f}' + ''.join(f'{t:16.3f}' for t in times) + f'{times[0]/times[-1]:10.1f}')
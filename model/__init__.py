@@ -1,4 +1,8 @@
-from .calorimeter import Calorimeter
+from .calorimeter import Calorimeter, top_contributors
 from .layer import Layer
 from .simulation import Simulation
+from .engine import VectorEngine, Population
 from .particle import Electron, Photon, Muon
+from .sparse import SparseHits
+from .library import ShowerLibrary
+from .parametric import ParametricSimulation, mean_pulls, spread_pulls, validation_failures, validation_report
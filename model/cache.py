@@ -0,0 +1,203 @@
+import glob
+import hashlib
+import os
+import numpy as np
+from .sparse import SparseHits
+
+
+def geometry(calorimeter):
+    '''Description of the geometry of a calorimeter used in cache keys: position, name,
+    material, thickness, response, height and number of cells of every volume. The numbers
+    are plain floats and ints, so equal geometries give the same key whatever the types
+    they were given with.'''
+    return [(float(v.z), str(v.layer._name), float(v.layer._material), float(v.layer._thickness),
+             float(v.layer._yield), float(v.layer._height), int(v.layer._numcells))
+            for v in calorimeter._volumes]
+
+
+def seed_key(seed):
+    '''The entropy and spawn key of a seed, or of the SeedSequence it gives, as plain ints
+    for cache keys.'''
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    entropy = seed.entropy
+    entropy = int(entropy) if np.ndim(entropy) == 0 else tuple(int(e) for e in entropy)
+    return entropy, tuple(int(k) for k in seed.spawn_key)
+
+
+class ResultCache:
+    '''Keeps the results of Simulation.simulate in a directory, named by a hash of everything
+    that determines them: the geometry, the engine and its version, the energy floor, the
+    shower library, the incoming particle, std, whether the cells are simulated and the
+    master seed. The events of an entry are stored in chunks, one file per simulated block
+    named by the hash, the first event and the number of events, so an entry grows and is
+    kept block by block while it is simulated. Since every event has its own stream derived
+    from the seed (see rng.event_seed), an entry with fewer runs than asked for is extended
+    with only the missing events, and a request for fewer runs returns the first ones. For
+    the 'batch' engine the events depend on how they are grouped, which is by number for
+    simulate and by block for simulate_blocks, so there both are part of the key as well.
+    Other engines give the same events whatever the grouping and number of workers.
+
+    With max_bytes the entries used longest ago are removed once the directory grows beyond
+    that size.'''
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, simulation, particle, std, seed, number=None, lateral=True, block=None):
+        '''The hash naming the results of these settings. number and block only count for
+        the batch engine, block defaults to number as in simulate.'''
+        library = simulation._library
+        if library is not None:
+            library = hashlib.sha1(b''.join(np.ascontiguousarray(a).tobytes() for a in
+                                            (library._edges, library._depths, library._offsets,
+                                             library._volume, library._dx, library._dy, library._count,
+                                             library._layer_offsets, library._layer_volume,
+                                             library._layer_missed))).hexdigest()
+        grouping = None
+        if simulation._engine == 'batch':
+            grouping = (int(number), int(number if block is None else min(block, number)))
+        # Plain floats and ints only, so that for instance 2 and np.float64(2.0) agree
+        settings = repr((geometry(simulation._calorimeter), simulation._engine, simulation.VERSION,
+                         simulation.ITERATIONS, float(simulation._energy_floor), library,
+                         (str(particle.name),) + tuple(float(a) for a in (
+                             particle.z, particle.x, particle.y, particle.energy,
+                             particle.xangle, particle.yangle)),
+                         None if std is None else float(std), bool(lateral), seed_key(seed),
+                         grouping))
+        return hashlib.sha1(settings.encode()).hexdigest()
+
+    def _filename(self, key, first, number):
+        return os.path.join(self.directory, f'result_{key}_{first}_{number}.npz')
+
+    def _chunks(self, key):
+        '''The chunks of key that follow on from each other from the first event, as a list
+        of (first, number, filename).'''
+        found = {}
+        for f in glob.glob(os.path.join(self.directory, f'result_{key}_*_*.npz')):
+            first, number = (int(n) for n in os.path.basename(f)[:-4].split('_')[2:])
+            if number > found.get(first, (0,))[0]:
+                found[first] = number, f
+        chunks, done = [], 0
+        while done in found:
+            number, f = found[done]
+            chunks.append((done, number, f))
+            done += number
+        return chunks
+
+    def _read(self, filename):
+        with np.load(filename) as f:
+            return f['ionisations'], f['cells'] if 'cells' in f else None
+
+    def load(self, key):
+        '''The ionisations and cells stored under key, or None if there are none. The cells
+        are None for results without lateral cells.'''
+        chunks = self._chunks(key)
+        if not chunks:
+            return None
+        parts = [self._read(f) for _, _, f in chunks]
+        self._touch(chunks)
+        return (np.concatenate([p[0] for p in parts]),
+                None if parts[0][1] is None else np.concatenate([p[1] for p in parts]))
+
+    def _touch(self, chunks):
+        # Mark as recently used for the eviction
+        for _, _, f in chunks:
+            os.utime(f)
+
+    def save(self, key, ionisations, cells, first=0):
+        '''Store the results of the events from first on under key, writing the file in one
+        go, then evict old entries.'''
+        filename = self._filename(key, first, len(ionisations))
+        arrays = {'ionisations': ionisations}
+        if cells is not None:
+            arrays['cells'] = cells
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(filename + '.tmp', filename)
+        self.evict(keep=key)
+
+    def simulate(self, simulation, particle, std, number, seed, workers=1, lateral=True):
+        '''The same as simulation.simulate(particle, std, number, workers=workers, seed=seed,
+        lateral=lateral), taken from the cache where possible. Only events that aren't there
+        yet are simulated. A seed is needed, without one results can't be reproduced.'''
+        if seed is None:
+            raise ValueError('Results can only be cached for a given seed')
+        key = self.key(simulation, particle, std, seed, number, lateral)
+        cached = self.load(key)
+        done = 0 if cached is None else len(cached[0])
+        if done >= number:
+            return cached[0][:number], None if cached[1] is None else cached[1][:number]
+
+        if done == 0:
+            ionisations, cells = simulation.simulate(particle, std, number, workers=workers,
+                                                     seed=seed, lateral=lateral)
+            self.save(key, ionisations, cells)
+            return ionisations, cells
+        new = next(simulation.simulate_blocks(particle, std, number, block=number - done,
+                                              seed=seed, start=done, lateral=lateral))
+        self.save(key, new[0], new[1], first=done)
+        return (np.concatenate((cached[0], new[0])),
+                None if new[1] is None else np.concatenate((cached[1], new[1])))
+
+    def simulate_blocks(self, simulation, particle, std, number, block=100, seed=None,
+                        sparse=False, start=0, lateral=True):
+        '''The same as simulation.simulate_blocks with these arguments, taken from the cache
+        where possible. The cached events are handed out a chunk at a time, then the missing
+        ones are simulated in blocks, each stored in the cache as soon as it is done. So
+        memory use doesn't grow with number, and an interrupted run keeps its finished blocks
+        in the cache as well.'''
+        if seed is None:
+            raise ValueError('Results can only be cached for a given seed')
+        key = self.key(simulation, particle, std, seed, number, lateral, block)
+        chunks = [c for c in self._chunks(key) if c[0] < number]
+        self._touch(chunks)
+        done = start
+        for first, count, f in chunks:
+            if first + count <= done:
+                continue
+            ionisations, cells = self._read(f)
+            a, b = done - first, min(count, number - first)
+            done = first + b
+            cells = None if cells is None else cells[a:b]
+            yield ionisations[a:b], SparseHits.from_dense(cells) if sparse and cells is not None else cells
+
+        for ionisations, cells in simulation.simulate_blocks(particle, std, number, block, seed,
+                                                             start=done, lateral=lateral):
+            self.save(key, ionisations, cells, first=done)
+            done += len(ionisations)
+            yield ionisations, SparseHits.from_dense(cells) if sparse and cells is not None else cells
+
+    def size(self):
+        '''Total size of the cached results in bytes.'''
+        return sum(os.path.getsize(f) for f in self._files())
+
+    def _files(self):
+        return glob.glob(os.path.join(self.directory, 'result_*.npz'))
+
+    def evict(self, keep=None):
+        '''Remove the entries used longest ago, all chunks of an entry together, until the
+        cache is no larger than max_bytes, never removing the entry with key keep.'''
+        if self.max_bytes is None:
+            return
+        entries = {}
+        for f in self._files():
+            key = os.path.basename(f).split('_')[1]
+            entries.setdefault(key, []).append(f)
+        used = {key: max(os.path.getmtime(f) for f in files) for key, files in entries.items()}
+        total = self.size()
+        for key in sorted(entries, key=used.get):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for f in entries[key]:
+                total -= os.path.getsize(f)
+                os.remove(f)
+
+    def clear(self):
+        '''Remove all cached results.'''
+        for f in self._files():
+            os.remove(f)
@@ -1,5 +1,24 @@
+import bisect
 import copy
 import numpy as np
+from . import rng
+
+
+def top_contributors(by_primary, k=2):
+    '''Compact version of the cells split by incoming particle, by_primary as returned by
+    Simulation.simulate_event or Calorimeter.ions_by_primary, an array (particles, layers,
+    cells, cells). For each cell of each layer gives the indices of the k incoming particles
+    that deposited most in it, largest first, and the fraction of the cell each of them
+    deposited. Both arrays are (layers, cells, cells, k), cells without ionisation have
+    fractions of zero.'''
+    by_primary = np.asarray(by_primary)
+    k = min(k, len(by_primary))
+    index = np.argsort(-by_primary, axis=0, kind='stable')[:k]
+    top = np.take_along_axis(by_primary, index, axis=0)
+    total = by_primary.sum(0)
+    fraction = np.divide(top, total, out=np.zeros_like(top), where=total > 0)
+    return np.moveaxis(index, 0, -1), np.moveaxis(fraction, 0, -1)
+
 
 class Calorimeter:
     '''This defines the calorimeter. The model is a strict one dimensinal model,
@@ -15,64 +34,211 @@ class Calorimeter:
 
     def __init__(self, volumes=[]):
         self._volumes = volumes.copy()
-        self._zend = 0
+        self._build_geometry()
+
+    def __setstate__(self, state):
+        # Copies (also by pickling) must get their own buffers for the layers to write in
+        self.__dict__.update(state)
+        self._build_geometry()
+
+    def _build_geometry(self):
+        '''Collect the geometry in arrays with one entry per volume: start z, thickness,
+        X0 per cm, response and whether the layer is active. Also build the sorted start and
+        end positions, used to find the volume containing a z position without scanning all
+        of them, and one (volumes, cells, cells) buffer for the deposits. The _cells of each
+        layer becomes a view into the buffer, so all deposits end up in it and it can be
+        cleared and read in one go. The layers keep their ionisation totals as plain numbers,
+        which is fastest for the per particle updates of Layer.ionise.'''
+        layers = [v.layer for v in self._volumes]
+        self._z = np.array([v.z for v in self._volumes], dtype=float)
+        self._thickness = np.array([l._thickness for l in layers], dtype=float)
+        self._material = np.array([l._material for l in layers], dtype=float)
+        self._response = np.array([l._yield for l in layers], dtype=float)
+        self._numcells = np.array([l._numcells for l in layers], dtype=int)
+        self._cellsize = np.array([l._cellsize for l in layers], dtype=float)
+        self._active_mask = self._response > 0
+        self._active = np.flatnonzero(self._active_mask)
+        self._zend = (self._z + self._thickness).max(initial=0.0)
+
+        order = np.argsort(self._z, kind='stable')
+        self._order = order
+        self._starts = self._z[order]
+        self._ends = self._starts + self._thickness[order]
+        self._zorder = order.tolist()
+        self._zstarts = self._starts.tolist()
+        self._zends = self._ends.tolist()
+        # Between two neighbouring starts or ends all positions are in the same volume, or in
+        # none, so locate_many only has to find the interval
+        self._bounds = np.unique(np.concatenate((self._starts, self._ends)))
+        self._bound_volume = np.array([-1] + [self.locate(z) for z in self._bounds], dtype=int)
+
+        size = self._numcells.max(initial=0)
+        self._buffer = np.zeros((len(layers), size, size))
+        for i, l in enumerate(layers):
+            n = l._numcells
+            self._buffer[i, :n, :n] = l._cells
+            l._cells = self._buffer[i, :n, :n]
+        self._active_layers = [layers[i] for i in self._active]
+        self.track_primaries(getattr(self, '_primaries', 0))
+        self.track_cells(getattr(self, '_lateral', True))
+        self.use_random(getattr(self, '_pool', None) or rng.RandomPool())
+
+    def use_random(self, pool):
+        '''Draw the random numbers of the layers, and of the particles interacting in them,
+        from pool, a RandomPool. Every calorimeter starts with a pool of its own, so
+        simulations in one calorimeter don't change the streams anything else draws from.'''
+        self._pool = pool
+        for v in self._volumes:
+            v.layer._pool = pool
+
+    def track_cells(self, lateral=True):
+        '''Record the ionisation in the cells of the layers, or with lateral=False only the
+        total ionisation of each layer, which is all Layer.ionise does then.'''
+        self._lateral = lateral
+        for v in self._volumes:
+            v.layer._lateral = lateral
+
+    def track_primaries(self, number):
+        '''Record the cells of each of number incoming particles separately as well, in a
+        (number, volumes, cells, cells) buffer that the layers see as their _truth. Particles
+        say which incoming particle they belong to with their primary attribute. Use zero to
+        stop recording.'''
+        self._primaries = number
+        self._truth = np.zeros((number,) + self._buffer.shape) if number else None
+        for i, v in enumerate(self._volumes):
+            n = v.layer._numcells
+            v.layer._truth = self._truth[:, i, :n, :n] if number else None
+
+    def locate(self, z):
+        '''Index of the volume containing position z, or -1 if it is outside all volumes.'''
+        i = bisect.bisect_right(self._zstarts, z) - 1
+        if i < 0 or z >= self._zends[i]:
+            return -1
+        return self._zorder[i]
+
+    def locate_many(self, z):
+        '''Array version of locate for an array of z positions.'''
+        return self._bound_volume[np.searchsorted(self._bounds, z, side='right')]
 
     def add_layer(self, layer):
         '''Add a single layer to the back of the calorimeter.'''
-        self._volumes.append(self.Volume(self._zend, copy.deepcopy(layer)))
-        self._zend += layer._thickness
+        self.add_layers([layer])
 
     def add_layers(self, layers):
-        '''Add a list of layers, one after the other to the back of the calorimeter.'''
+        '''Add a list of layers, one after the other to the back of the calorimeter.
+        Each layer is copied, its deposits move into the buffers of the calorimeter.'''
+        z = self._zend
         for l in layers:
-            self.add_layer(l)
+            self._volumes.append(self.Volume(z, copy.copy(l)))
+            z += l._thickness
+        self._build_geometry()
 
     def step(self, particle, std, step):
         '''Move a particle by the amount step forward in the calorimeter,
         Return a list of particles created during
         the step. If particle doesn't do anything it is just stepped forward.'''
 
-        involume = False
-        for volume in self._volumes:
-            if (particle.z >= volume.z) and (particle.z < volume.z + volume.layer._thickness):
-                involume = True
-                break
-
-        # Looping through every layer to check if particle within that layer
-        # If found, then break
+        index = self.locate(particle.z)
         particle.move(step)
 
         particles = [particle]
-        if involume:
-            layer = volume.layer
+        if index >= 0:
+            layer = self._volumes[index].layer
             layer.ionise(particle, step)
             particles = layer.interact(particle, std, step)
 
         return particles
 
+    def transport(self, particle, std, steps, step=0.1, energy_floor=0.0, library=None):
+        '''Transport a particle and everything it creates through the calorimeter as repeated
+        calls of step with the given step would, for at most steps steps, but jumping from one
+        interaction to the next. In each layer the number of steps up to the next interaction
+        is drawn from Layer.free_steps, which has the distribution of the per step draws of
+        Layer.interact. The particle either jumps that many steps or to its last step in the
+        layer, ionising all of them at once. The positions are those of the step engine, the
+        start position with step added once per step, so a particle takes the same steps in
+        each layer. Particles are dropped below energy_floor, particles that a ShowerLibrary
+        replaces get a library shower instead. Returns the number of steps of the longest
+        chain of particles, as Simulation counts them, and the number of steps of all
+        particles together, those jumped over included.'''
+        z = np.cumsum(np.concatenate(([particle.z], np.full(steps, step))))
+        volume = self.locate_many(z)
+        # Nothing happens any more behind the calorimeter
+        last = min(steps, int(np.searchsorted(z, self._zend)))
+        # The steps from i to ends[i] are all taken in the same volume
+        change = np.flatnonzero(volume[1:] != volume[:-1]) + 1
+        ends = np.append(change, len(z))[np.searchsorted(change, np.arange(len(z)), side='right')]
+        ends = np.minimum(ends, last).tolist()
+        volume = volume.tolist()
+        z = z.tolist()
+
+        particles = [(particle, 0)]
+        longest = moved = 0
+        while particles:
+            p, i = particles.pop()
+            first = i
+            while i < last and p.energy >= energy_floor:
+                v = volume[i]
+                if v < 0:
+                    # Nothing happens in front of or between the layers
+                    i = ends[i]
+                    p.z = z[i]
+                    continue
+                if library is not None and library.replaces(p):
+                    library.deposit(self, p, v)
+                    break
+                layer = self._volumes[v].layer
+                k = layer.free_steps(step)
+                n = ends[i] - i
+                layer.ionise(p, min(k, n)*step)
+                i += min(k, n)
+                p.z = z[i]
+                if k <= n:
+                    particles.extend((q, i) for q in p.interact(std, self._pool))
+                    break
+            longest = max(longest, i)
+            moved += i - first
+        return longest, moved
+
     def positions(self, active=True):
         '''Provide an array of the z coordinates for the start of each layer. If active=True, only return the active layers'''
-        return np.array([v.z for v in self._volumes if not active or v.layer._yield>0])
+        return self._z[self._active] if active else self._z.copy()
 
     def ionisations(self, active=True):
         '''Provide a list of the ionisation deposited in each of the layers. If active=True, only return the active layers'''
-        return np.array([v.layer._ionisation for v in self._volumes if not active or v.layer._yield>0])
-
-    def ions_by_layer(self, active=True):
-        return np.array([v.layer._cells for v in self._volumes if not active or v.layer._yield>0])
+        layers = self._active_layers if active else [v.layer for v in self._volumes]
+        return np.fromiter((l._ionisation for l in layers), dtype=float, count=len(layers))
+
+    def cells_shape(self, active=True):
+        '''Shape of the array returned by ions_by_layer.'''
+        numcells = self._numcells[self._active] if active else self._numcells
+        size = numcells.max(initial=0)
+        return (len(numcells), size, size)
+
+    def ions_by_layer(self, active=True, out=None):
+        '''Provide an array of the ionisation in the cells of each of the layers. If active=True, only return
+        the active layers. If out is given the cells are written into it.'''
+        index = self._active if active else np.arange(len(self._volumes))
+        size = self.cells_shape(active)[1]
+        return np.take(self._buffer[:, :size, :size], index, axis=0, out=out)
+
+    def ions_by_primary(self, active=True):
+        '''Provide an array of the ionisation in the cells of each of the layers for each of the
+        tracked incoming particles, see track_primaries.'''
+        index = self._active if active else np.arange(len(self._volumes))
+        size = self.cells_shape(active)[1]
+        return self._truth[:, index, :size, :size]
 
     def ions_missed(self):
-        missed = []
-        for v in self._volumes:
-                miss = v.layer._missed
-                missed.append(miss)
-        return missed
+        return [v.layer._missed for v in self._volumes]
 
     def reset(self):
         '''Clears the recorded ionisation in each layer'''
+        self._buffer.fill(0.0)
+        if self._truth is not None:
+            self._truth.fill(0.0)
         for v in self._volumes:
-            v.layer._ionisation=0
-            v.layer._cells = np.zeros((v.layer._numcells, v.layer._numcells))
+            v.layer._ionisation = 0
 
     def __str__(self):
         txt = 'The layers of the calorimeter:\n'
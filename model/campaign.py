@@ -0,0 +1,167 @@
+import os
+import pickle
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from functools import partial
+from . import rng
+from .cache import geometry
+from .particle import Electron
+from .simulation import Simulation
+from .writer import HitWriter
+
+
+CHECKPOINT = 'campaign_checkpoint.p'
+
+
+def expected_cost(energy, num_runs):
+    '''Rough cost of simulating num_runs showers of the given energy. The number of
+    particles in a shower, and so the time taken, grows linearly with the energy.'''
+    return energy*num_runs
+
+
+def data_filename(energy, num_runs):
+    '''Name of the data file of an energy point.'''
+    return '%.1fGeV_%iruns_data.h5' % (energy, num_runs)
+
+
+def _run_block(calorimeter, energy, num_runs, sigma, x, y, seed, engine, sparse, block, cache,
+               first, count):
+    '''Simulate runs first to first + count of an energy point of num_runs runs, the same
+    runs as simulating the whole point in blocks of block runs from first on. With a
+    ResultCache the runs are taken from it where it has them, simulating only what it is
+    missing and storing that in it as well.
+    Returns the cells of the runs, as a list of blocks, and the time taken.'''
+    electron = Electron(0.0, x, y, energy, 0, 0)
+    sim = Simulation(calorimeter, engine=engine)
+    tic = time.time()
+    blocks = sim.simulate_blocks if cache is None else partial(cache.simulate_blocks, sim)
+    parts, done = [], 0
+    for _, counts_layers in blocks(electron, sigma, num_runs, block, seed, sparse, start=first):
+        # Chunks from the cache can reach past the runs asked for
+        parts.append(counts_layers[:count - done])
+        done += len(parts[-1])
+        if done == count:
+            break
+    toc = time.time()
+    return parts, toc - tic
+
+
+def save_dict(directory, energy, num_runs, energies_dict):
+    '''Pickle the dictionary with the settings and timing of the energy points done so far.'''
+    dict_filename = '%.1fGeV_%iruns_dict.p' % (energy, num_runs)
+    with open(os.path.join(directory, dict_filename), 'wb') as handle:
+        pickle.dump(energies_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_checkpoint(directory):
+    '''The checkpoint of a campaign in directory, or None if there is none.'''
+    filename = os.path.join(directory, CHECKPOINT)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as handle:
+        return pickle.load(handle)
+
+
+def save_checkpoint(directory, checkpoint):
+    '''Replace the checkpoint of a campaign in one go, so a killed job never leaves half a file.'''
+    filename = os.path.join(directory, CHECKPOINT)
+    with open(filename + '.tmp', 'wb') as handle:
+        pickle.dump(checkpoint, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(filename + '.tmp', filename)
+
+
+def run_campaign(calorimeter, energies, num_runs, directory, sigma=0.3, x=0, y=0,
+                 seed=None, workers=None, engine='step', sparse=False, block=100,
+                 compression=None, resume=False, cache=None):
+    '''Simulate num_runs electrons for each energy and write the same files as simulator.py.
+    Every block of block runs of an energy point is a job for a pool of processes, so even
+    a few energy points keep all cores busy. The jobs are submitted most expensive first,
+    so the blocks of the long high energy points start straight away and the short ones
+    fill up the gaps at the end. The random stream of each point is derived from seed by
+    its position in energies, and each run has its own seed spawned from that, so results
+    don't depend on the scheduling, and run i of point j can be simulated again on its own
+    with Simulation.simulate_again and the seed rng.event_seed(entropy, j), where entropy is
+    the one kept in the checkpoint. The data files are written by this process, each block
+    appended in order as soon as the blocks before it are done. With sparse the files hold
+    only the occupied cells, see SparseHits, optionally compressed with the given HDF5
+    compression filter.
+
+    Progress is recorded in a checkpoint file in directory holding the master seed, the
+    settings and the finished energy points, and every data file records its finished
+    blocks of runs. With resume a killed campaign continues from there, provided it is
+    resumed with the same energies, runs, sigma, x, y, engine and geometry: finished points are skipped, unfinished
+    ones continue after their last complete block, and since each run has its own seed
+    spawned from the same master seed the result is the same as an uninterrupted campaign.
+    With cache, a ResultCache, energy points simulated before with the same settings and
+    seed are read from it instead, see ResultCache.simulate_blocks. The seed has to be given
+    for that, otherwise every campaign draws a new one.
+
+    Returns the dictionary with the settings and timing of every energy point.'''
+    energies = list(energies)
+    settings = {'num_runs': int(num_runs), 'energies': [float(e) for e in energies],
+                'sigma': float(sigma), 'x': float(x), 'y': float(y), 'engine': engine,
+                'geometry': geometry(calorimeter)}
+    if engine == 'batch':
+        # The batch engine's events depend on how they are grouped into blocks
+        settings['block'] = int(block)
+    checkpoint = load_checkpoint(directory) if resume else None
+    if checkpoint is None:
+        checkpoint = {'entropy': np.random.SeedSequence(seed).entropy, 'settings': settings,
+                      'energies_dict': {}}
+        save_checkpoint(directory, checkpoint)
+    elif checkpoint.get('settings') != settings:
+        old = checkpoint.get('settings', {})
+        changed = ', '.join(k for k in settings if old.get(k) != settings[k])
+        raise ValueError(f'Cannot resume, the campaign in {directory} has other settings: {changed}')
+    seeds = [rng.event_seed(checkpoint['entropy'], j) for j in range(len(energies))]
+    energies_dict = checkpoint['energies_dict']
+
+    todo = [i for i in range(len(energies)) if str(energies[i]) not in energies_dict]
+    shape = calorimeter.ions_by_layer().shape
+
+    def finish(i, taken):
+        energy = energies[i]
+        print(f'Energy {energy} done, that took {taken} seconds')
+        energies_dict[str(energy)] = {"Energy": energy, "num_runs": num_runs,
+                                      "enterx": x, "entery": y, "sigma": sigma,
+                                      "time_taken": taken}
+        save_dict(directory, energy, num_runs, energies_dict)
+        save_checkpoint(directory, checkpoint)
+
+    with ExitStack() as stack:
+        # With resume the runs already in a data file are skipped
+        writers = {i: stack.enter_context(HitWriter(os.path.join(directory, data_filename(energies[i], num_runs)),
+                                                    shape, num_runs, sparse=sparse,
+                                                    compression=compression, seed=seeds[i],
+                                                    resume=resume))
+                   for i in todo}
+        jobs = [(i, first, min(block, num_runs - first)) for i in todo
+                for first in range(writers[i].runs_done, num_runs, block)]
+        jobs.sort(key=lambda job: expected_cost(energies[job[0]], job[2]), reverse=True)
+        for i in todo:
+            if writers[i].runs_done >= num_runs:
+                writers[i].close()
+                finish(i, 0.0)
+
+        # Blocks that are done but wait for earlier ones of their point, and the time taken
+        waiting = {i: {} for i in todo}
+        taken = {i: 0.0 for i in todo}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_run_block, calorimeter, energies[i], num_runs, sigma, x, y,
+                                   seeds[i], engine, sparse, block, cache, first, count): (i, first)
+                       for i, first, count in jobs}
+            for future in as_completed(futures):
+                i, first = futures[future]
+                waiting[i][first], block_taken = future.result()
+                taken[i] += block_taken
+                writer = writers[i]
+                while writer.runs_done in waiting[i]:
+                    for part in waiting[i].pop(writer.runs_done):
+                        writer.append(part)
+                if writer.runs_done >= num_runs:
+                    writer.close()
+                    finish(i, taken[i])
+
+    return energies_dict
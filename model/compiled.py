@@ -0,0 +1,156 @@
+import numpy as np
+from .engine import ELECTRON, PHOTON, Population, _CUTOFFS
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+AVAILABLE = njit is not None
+
+
+def _grow(a, size):
+    '''Copy of array a with room for size entries.'''
+    grown = np.empty(size, dtype=a.dtype)
+    grown[:len(a)] = a
+    return grown
+
+
+def _transport(seed, z0, x0, y0, energy0, xangle0, yangle0, kind0, std, step, iterations,
+               energy_floor, starts, ends, order, material, yields, numcells, cellsize, zend,
+               cutoffs, cells, ionisation, missed, lateral, offsets):
+    '''The whole transport of an event as one loop over a stack of particles held in arrays.
+    Same physics as Calorimeter.step, with the ionisation added to ionisation per volume and,
+    if lateral, to cells and missed. Without offsets no lateral offsets are drawn. Returns
+    the number of steps taken, the largest number of live particles and the steps of all
+    particles together.'''
+    np.random.seed(seed)
+    scale = np.sqrt(std)
+    n = len(z0)
+    size = max(2*n, 1024)
+    z, x, y = np.empty(size), np.empty(size), np.empty(size)
+    energy, xangle, yangle = np.empty(size), np.empty(size), np.empty(size)
+    kind = np.empty(size, dtype=np.int8)
+    z[:n], x[:n], y[:n] = z0, x0, y0
+    energy[:n], xangle[:n], yangle[:n], kind[:n] = energy0, xangle0, yangle0, kind0
+
+    iter = 0
+    peak = n
+    moved = 0
+    while iter < iterations and n > 0:
+        peak = max(peak, n)
+        moved += n
+        if 3*n > size:
+            size = 3*n
+            z, x, y = _grow(z, size), _grow(x, size), _grow(y, size)
+            energy, xangle, yangle = _grow(energy, size), _grow(xangle, size), _grow(yangle, size)
+            kind = _grow(kind, size)
+
+        # Live particles are at 0..n-1, the next generation is written from n onwards
+        m = n
+        for i in range(n):
+            j = np.searchsorted(starts, z[i], side='right') - 1
+            v = -1
+            if j >= 0 and z[i] < ends[j]:
+                v = order[j]
+            znew = z[i] + step
+
+            if v >= 0:
+                if kind[i] == ELECTRON:
+                    count = yields[v]*step
+                    ionisation[v] += count
+                    if yields[v] > 0 and lateral:
+                        mid = numcells[v]//2
+                        ux = x[i]/cellsize[v]
+                        uy = y[i]/cellsize[v]
+                        if abs(ux) <= mid and abs(uy) <= mid:
+                            xc = int(np.floor(ux + mid))
+                            yc = int(np.floor(uy + mid))
+                            if xc < numcells[v] and yc < numcells[v]:
+                                cells[v, yc, xc] += count
+                            else:
+                                missed[v] += count
+                        else:
+                            missed[v] += count
+
+                if np.random.random() < material[v]*step:
+                    if energy[i] > cutoffs[kind[i]]:
+                        split = np.random.random()
+                        for c in range(2):
+                            e = split*energy[i] if c == 0 else (1.0 - split)*energy[i]
+                            if znew < zend and e >= energy_floor:
+                                z[m] = znew
+                                if offsets:
+                                    x[m] = x[i] + scale*np.random.standard_normal() + xangle[i]
+                                    y[m] = y[i] + scale*np.random.standard_normal() + yangle[i]
+                                else:
+                                    x[m] = x[i] + xangle[i]
+                                    y[m] = y[i] + yangle[i]
+                                energy[m] = e
+                                xangle[m] = xangle[i]
+                                yangle[m] = yangle[i]
+                                if c == 0 or kind[i] == PHOTON:
+                                    kind[m] = ELECTRON
+                                else:
+                                    kind[m] = PHOTON
+                                m += 1
+                    continue
+
+            if znew < zend and energy[i] >= energy_floor:
+                z[m] = znew
+                x[m], y[m], energy[m] = x[i], y[i], energy[i]
+                xangle[m], yangle[m], kind[m] = xangle[i], yangle[i], kind[i]
+                m += 1
+
+        # Move the next generation to the front of the stack
+        k = m - n
+        z[:k], x[:k], y[:k] = z[n:m].copy(), x[n:m].copy(), y[n:m].copy()
+        energy[:k], xangle[:k], yangle[:k] = energy[n:m].copy(), xangle[n:m].copy(), yangle[n:m].copy()
+        kind[:k] = kind[n:m].copy()
+        n = k
+        iter += 1
+    return iter, peak, moved
+
+
+if AVAILABLE:
+    _grow = njit(cache=True)(_grow)
+    _kernel = njit(cache=True)(_transport)
+
+
+class CompiledEngine:
+    '''Transports a whole event in a single compiled loop (needs Numba). The geometry
+    arrays and cell buffer of the calorimeter are handed to the kernel as they are and the
+    particles live on array backed stacks, so nothing is allocated per step. The physics
+    is the same as for Calorimeter.step.'''
+
+    def __init__(self, calorimeter):
+        if not AVAILABLE:
+            raise ImportError('The compiled engine needs numba')
+        self._calorimeter = calorimeter
+        self.peak = 0
+        self.moved = 0
+
+    def run(self, particles, std, step=0.1, iterations=1000, energy_floor=0.0):
+        '''Transport the particles through the calorimeter as VectorEngine.run does, without
+        lateral offsets when std is None. Returns the number of steps taken, the largest
+        number of live particles is kept in peak and the steps of all particles together
+        in moved.'''
+        cal = self._calorimeter
+        if len(cal._volumes) == 0:
+            self.peak = self.moved = 0
+            return 0
+        pop = Population.from_particles(particles)
+        ionisation = np.zeros(len(cal._volumes))
+        missed = np.zeros(len(cal._volumes))
+        seed = int(cal._pool.generator.integers(2**32))
+
+        iter, self.peak, self.moved = _kernel(seed, pop.z, pop.x, pop.y, pop.energy, pop.xangle, pop.yangle, pop.kind,
+                       0.0 if std is None else float(std), float(step), int(iterations), float(energy_floor),
+                       cal._starts, cal._ends, cal._order, cal._material, cal._response,
+                       cal._numcells, cal._cellsize, float(cal._zend), _CUTOFFS,
+                       cal._buffer, ionisation, missed, bool(cal._lateral), std is not None)
+
+        for v, volume in enumerate(cal._volumes):
+            volume.layer._ionisation += ionisation[v]
+            volume.layer._missed += missed[v]
+        return iter
@@ -0,0 +1,204 @@
+import numpy as np
+from .particle import Electron, Photon
+
+ELECTRON = 0
+PHOTON = 1
+
+_KINDS = {'elec': ELECTRON, 'phot': PHOTON}
+_CUTOFFS = np.array([Electron(0.0, 0.0, 0.0, 0.0, 0.0, 0.0).cutoff,
+                     Photon(0.0, 0.0, 0.0, 0.0, 0.0, 0.0).cutoff])
+
+
+class Population:
+    '''Structure of arrays holding every live particle of a shower. Each field is a
+    NumPy array with one entry per particle. event is the index of the event a particle
+    belongs to when several events are transported together.'''
+
+    FIELDS = ('z', 'x', 'y', 'energy', 'xangle', 'yangle', 'kind', 'event')
+
+    def __init__(self, z, x, y, energy, xangle, yangle, kind, event=None):
+        self.z = z
+        self.x = x
+        self.y = y
+        self.energy = energy
+        self.xangle = xangle
+        self.yangle = yangle
+        self.kind = kind
+        self.event = np.zeros(len(z), dtype=np.int64) if event is None else event
+
+    @classmethod
+    def from_particles(cls, particles, events=None):
+        '''Build a population from a list of particle objects, optionally with the index of
+        the event of each.'''
+        for p in particles:
+            if p.name not in _KINDS:
+                raise ValueError(f'Particle type {p.name} is not supported by the vector engine')
+        return cls(np.array([p.z for p in particles], dtype=float),
+                   np.array([p.x for p in particles], dtype=float),
+                   np.array([p.y for p in particles], dtype=float),
+                   np.array([p.energy for p in particles], dtype=float),
+                   np.array([p.xangle for p in particles], dtype=float),
+                   np.array([p.yangle for p in particles], dtype=float),
+                   np.array([_KINDS[p.name] for p in particles], dtype=np.int8),
+                   None if events is None else np.asarray(events, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.z)
+
+    def select(self, mask):
+        '''Return a new population containing the particles where mask is True.'''
+        return Population(*[getattr(self, f)[mask] for f in self.FIELDS])
+
+    def extend(self, other):
+        '''Return a new population with the particles of other appended.'''
+        return Population(*[np.concatenate((getattr(self, f), getattr(other, f))) for f in self.FIELDS])
+
+
+class VectorEngine:
+    '''Transports a whole shower at once. Instead of stepping particle objects one by
+    one through Calorimeter.step, all particles are kept in a Population and every
+    step, ionisation and interaction is done for the full population with array
+    operations. The physics is the same as for the object based stepping.'''
+
+    def __init__(self, calorimeter):
+        self._calorimeter = calorimeter
+        self.peak = 0
+        self.moved = 0
+
+    def run(self, particles, std, step=0.1, iterations=1000, energy_floor=0.0):
+        '''Transport the particles through the calorimeter for at most a number of steps. The
+        ionisation is recorded in the layers of the calorimeter as for Calorimeter.step.
+        Particles leaving the back of the calorimeter or with an energy below energy_floor
+        are dropped. Returns the number of steps taken before no particle was left, the
+        largest number of live particles is kept in peak and the steps of all particles
+        together in moved.'''
+        cal = self._calorimeter
+        nvolumes = len(cal._volumes)
+        ionisations = np.zeros((1, nvolumes))
+        missed = np.zeros((1, nvolumes))
+        # The cells go straight into the buffer of the calorimeter, which holds all volumes
+        cells = cal._buffer[np.newaxis] if cal._lateral else None
+        slots = np.where(cal._active_mask, np.arange(nvolumes), -1)
+        steps = self._transport(Population.from_particles(particles), std, step, iterations,
+                                energy_floor, ionisations, missed, cells, slots)
+        for v, volume in enumerate(cal._volumes):
+            volume.layer._ionisation += ionisations[0, v]
+            volume.layer._missed += missed[0, v]
+        self.moved = int(self.moved[0])
+        return int(steps[0])
+
+    def run_batch(self, particles, std, step=0.1, iterations=1000, energy_floor=0.0):
+        '''Transport a batch of independent events together as one population, particle i
+        being the incoming particle of event i. Same physics as run, but the ionisation is
+        not recorded in the layers. Returns the ionisation of every event in each volume,
+        an array (events, volumes), the cells of every event in each active volume, an array
+        (events, active volumes, cells, cells) as Calorimeter.ions_by_layer, or None when the
+        calorimeter doesn't track the cells, and the number of steps taken in each event. The
+        largest number of live particles of the batch is kept in peak, the steps of all
+        particles of each event together in moved.'''
+        cal = self._calorimeter
+        nevents, nvolumes = len(particles), len(cal._volumes)
+        size = cal.cells_shape()[1]
+        ionisations = np.zeros((nevents, nvolumes))
+        missed = np.zeros((nevents, nvolumes))
+        cells = np.zeros((nevents, len(cal._active), size, size)) if cal._lateral else None
+        # Position of each volume among the active ones, -1 for passive volumes
+        slots = np.full(nvolumes, -1)
+        slots[cal._active] = np.arange(len(cal._active))
+        steps = self._transport(Population.from_particles(particles, np.arange(nevents)), std, step,
+                                iterations, energy_floor, ionisations, missed, cells, slots)
+        return ionisations, cells, steps
+
+    def _transport(self, pop, std, step, iterations, energy_floor, ionisations, missed, cells, slots):
+        '''The loop of run and run_batch. Transports the population for at most iterations
+        steps, adding the ionisation of each event in each volume to ionisations, an array
+        (events, volumes). If cells isn't None, an array (events, slots, cells, cells), the
+        ionisation of volume v also goes to its cells at position slots[v], or to missed,
+        also (events, volumes), where it falls outside them. Volumes with a slot of -1 have
+        no cells. All deposits of a step are added in one go. Returns the number of steps
+        taken in each event, the steps of all particles of each event together are kept in
+        moved.'''
+        cal = self._calorimeter
+        zend = cal._zend
+        material = cal._material
+        active = np.append(cal._active_mask, False)
+        nvolumes = len(cal._volumes)
+        steps = np.zeros(len(ionisations), dtype=int)
+        self.moved = np.zeros(len(ionisations), dtype=int)
+        self.peak = len(pop)
+
+        iter = 0
+        while iter < iterations:
+            if len(pop) == 0 or nvolumes == 0:
+                break
+            self.peak = max(self.peak, len(pop))
+            steps[pop.event] = iter + 1
+            self.moved += np.bincount(pop.event, minlength=len(steps))
+            # Index of the volume containing each particle, -1 if outside
+            idx = cal.locate_many(pop.z)
+            inside = idx >= 0
+
+            pop.z += step
+
+            # Only electrons in active volumes leave any ionisation
+            ionising = inside & (pop.kind == ELECTRON) & active[idx]
+            v = idx[ionising]
+            if len(v) > 0:
+                self._deposit(pop.x[ionising], pop.y[ionising], pop.event[ionising], v, step,
+                              ionisations, missed, cells, slots)
+
+            r = cal._pool.generator.random(len(pop))
+            hit = inside & (r < material[np.maximum(idx, 0)]*step)
+            if hit.any():
+                parents = pop.select(hit & (pop.energy > _CUTOFFS[pop.kind]))
+                pop = pop.select(~hit).extend(self._split(parents, std))
+            keep = (pop.z < zend) & (pop.energy >= energy_floor)
+            if not keep.all():
+                pop = pop.select(keep)
+            iter += 1
+        return steps
+
+    def _deposit(self, x, y, event, v, step, ionisations, missed, cells, slots):
+        '''Add the ionisation of one step of ionising particles at x, y of the given events in
+        volumes v, as described in _transport, with one scatter into each array.'''
+        cal = self._calorimeter
+        count = cal._response[v]*step
+        flat = event*ionisations.shape[1] + v
+        np.add.at(ionisations.reshape(-1), flat, count)
+        if cells is not None:
+            # Cells as in Layer.deposit, with the cell size and number of each particle's volume
+            numcells = cal._numcells[v]
+            mid = numcells//2
+            ux = x/cal._cellsize[v]
+            uy = y/cal._cellsize[v]
+            xcell = np.floor(ux + mid).astype(int)
+            ycell = np.floor(uy + mid).astype(int)
+            recorded = slots[v] >= 0
+            inside = (recorded & (np.abs(ux) <= mid) & (np.abs(uy) <= mid) &
+                      (xcell < numcells) & (ycell < numcells))
+            size = cells.shape[-1]
+            cell = ((event*cells.shape[1] + slots[v])*size + ycell)*size + xcell
+            np.add.at(cells.reshape(-1), cell[inside], count[inside])
+            outside = recorded & ~inside
+            np.add.at(missed.reshape(-1), flat[outside], count[outside])
+
+    def _split(self, parents, std):
+        '''Electrons radiate a photon and photons pair produce. Both give two new
+        particles sharing the energy of the parent randomly, without lateral offsets when std
+        is None.'''
+        n = len(parents)
+        generator = self._calorimeter._pool.generator
+        split = generator.random(n)
+        if std is None:
+            new = np.zeros((2, 2, n))
+        else:
+            new = np.sqrt(std)*generator.standard_normal((2, 2, n))
+
+        kind2 = np.where(parents.kind == ELECTRON, PHOTON, ELECTRON).astype(np.int8)
+        kinds = np.concatenate((np.full(n, ELECTRON, dtype=np.int8), kind2))
+        energy = np.concatenate((split*parents.energy, (1.0-split)*parents.energy))
+        twice = lambda a: np.concatenate((a, a))
+        x = twice(parents.x + parents.xangle) + new[:, 0].ravel()
+        y = twice(parents.y + parents.yangle) + new[:, 1].ravel()
+        return Population(twice(parents.z), x, y, energy, twice(parents.xangle),
+                          twice(parents.yangle), kinds, twice(parents.event))
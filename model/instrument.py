@@ -0,0 +1,109 @@
+import csv
+import time
+import numpy as np
+
+
+class Instrumentation:
+    '''Counters for the step engine, see Simulation.instrument. For every iteration of every
+    event it records the number of live particles, the steps in which a particle ionised,
+    the steps taken outside all volumes, the interactions in the layers of each name and the
+    time spent in the step, and of that in Layer.ionise and Layer.interact.'''
+
+    FIELDS = ('event', 'iteration', 'live', 'ionising', 'outside',
+              'time_step', 'time_ionise', 'time_interact')
+
+    def __init__(self, calorimeter):
+        self._calorimeter = calorimeter
+        self.names = sorted({v.layer._name for v in calorimeter._volumes})
+        self._name_index = [self.names.index(v.layer._name) for v in calorimeter._volumes]
+        self._rows = []
+        self._interactions = []
+        self._events = 0
+
+    def transport(self, simulation, particles, std, step=0.1):
+        '''The step loop of Simulation._transport with the counters added, each particle step
+        as in Calorimeter.step. Returns the number of steps taken.'''
+        cal = simulation._calorimeter
+        volumes = cal._volumes
+        zend = cal._zend
+        clock = time.perf_counter
+        event = self._events
+        self._events += 1
+
+        iter = 0
+        while iter < simulation.ITERATIONS and particles:
+            ionising = outside = 0
+            time_ionise = time_interact = 0.0
+            interactions = np.zeros(len(self.names), dtype=int)
+            next = []
+            start = clock()
+            for p in particles:
+                index = cal.locate(p.z)
+                p.move(step)
+                if index < 0:
+                    outside += 1
+                    next.append(p)
+                    continue
+                layer = volumes[index].layer
+                tic = clock()
+                layer.ionise(p, step)
+                toc = clock()
+                newparticles = layer.interact(p, std, step)
+                time_interact += clock() - toc
+                time_ionise += toc - tic
+                ionising += p.ionise
+                if len(newparticles) != 1 or newparticles[0] is not p:
+                    interactions[self._name_index[index]] += 1
+                next.extend(newparticles)
+            simulation._moved += len(particles)
+            self._rows.append((event, iter, len(particles), ionising, outside,
+                               clock() - start, time_ionise, time_interact))
+            self._interactions.append(interactions)
+
+            particles = [p for p in next if p.z < zend and p.energy >= simulation._energy_floor]
+            if simulation._library is not None:
+                particles = [p for p in particles if not simulation._substitute(p)]
+            iter += 1
+        return iter
+
+    def as_arrays(self):
+        '''The counters as a dictionary of arrays with one entry per iteration, the
+        interactions under "interactions_" followed by the layer name.'''
+        rows = np.array(self._rows, dtype=float).reshape(-1, len(self.FIELDS))
+        arrays = {f: rows[:, i] for i, f in enumerate(self.FIELDS)}
+        for f in self.FIELDS[:5]:
+            arrays[f] = arrays[f].astype(int)
+        interactions = np.array(self._interactions, dtype=int).reshape(-1, len(self.names))
+        for i, name in enumerate(self.names):
+            arrays['interactions_' + name] = interactions[:, i]
+        return arrays
+
+    def per_event(self):
+        '''The counters summed over the iterations of each event, with the number of
+        iterations under "iteration" and the largest number of live particles under "live".'''
+        arrays = self.as_arrays()
+        event = arrays.pop('event')
+        summary = {'event': np.arange(self._events)}
+        for key, values in arrays.items():
+            if key == 'iteration':
+                summary[key] = np.bincount(event, minlength=self._events)
+            elif key == 'live':
+                summary[key] = np.zeros(self._events, dtype=int)
+                np.maximum.at(summary[key], event, values)
+            else:
+                summary[key] = np.bincount(event, weights=values, minlength=self._events).astype(values.dtype)
+        return summary
+
+    def to_csv(self, filename, per_event=False):
+        '''Write the counters per iteration, or per event, to a CSV file.'''
+        arrays = self.per_event() if per_event else self.as_arrays()
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(arrays.keys())
+            writer.writerows(zip(*arrays.values()))
+
+    def clear(self):
+        '''Forget everything recorded so far.'''
+        self._rows = []
+        self._interactions = []
+        self._events = 0
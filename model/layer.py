@@ -1,6 +1,7 @@
-import random
+import math
 import numpy as np
 from scipy.stats import multivariate_normal
+from . import rng
 
 class Layer:
     '''Defines an individual layer of a calorimeter. The properties of the layer are
@@ -21,6 +22,12 @@ class Layer:
         self._cells = np.zeros((numcells, numcells))
         self._response = response
         self._missed = 0.0
+        # Cells split by incoming particle, (primaries, numcells, numcells), when tracked
+        self._truth = None
+        # Without lateral only the total ionisation is recorded, not the cells
+        self._lateral = True
+        # Where the random numbers come from, the calorimeter gives its layers its own pool
+        self._pool = rng.get_pool()
 
     def ionise(self, particle, step):
         '''Records the ionisation in each layer from a particle going a certain length.'''
@@ -31,7 +38,7 @@ class Layer:
 
             # Treating it as a line, total ionisation in all cells should equal
             # previous value
-            if self._response > 0:
+            if self._response > 0 and self._lateral:
 
                 cellsize = self._cellsize
                 midcell = int(np.floor(self._numcells/2))
@@ -57,18 +64,81 @@ class Layer:
 
                 if abs(xcell) < self._numcells and abs(ycell) < self._numcells:
                     self._cells[ycell, xcell] += count
+                    if self._truth is not None and particle.primary is not None:
+                        self._truth[particle.primary, ycell, xcell] += count
                 else:
                     self._missed += count
 
+    def _cell_index(self, u):
+        '''Cell index along one axis for positions u given in units of the cell size,
+        following the same rules as ionise. Positions outside the layer get numcells.'''
+        midcell = int(np.floor(self._numcells/2))
+        cell = np.floor(u + midcell).astype(int)
+        cell[(np.abs(u) > midcell) | (cell >= self._numcells)] = self._numcells
+        return cell
+
+    def deposit(self, x, y, count):
+        '''Records the ionisation of many ionising particles at once. x and y are arrays with
+        the positions of the particles and count the ionisation of each, either an array or
+        a single value for all. Ionisation outside the cells is added to the missed amount.'''
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        count = np.broadcast_to(np.asarray(count, dtype=float), x.shape)
+        self._ionisation += count.sum()
+
+        if self._response > 0 and self._lateral and len(x):
+            numcells = self._numcells
+            xcell = self._cell_index(x/self._cellsize)
+            ycell = self._cell_index(y/self._cellsize)
+            inside = (xcell < numcells) & (ycell < numcells)
+            flat = ycell[inside]*numcells + xcell[inside]
+            self._cells += np.bincount(flat, weights=count[inside],
+                                       minlength=numcells*numcells).reshape(numcells, numcells)
+            self._missed += count[~inside].sum()
+
+    def deposit_cells(self, x, y, xoffset, yoffset, count, missed=0.0, primary=None):
+        '''Records ionisation given per cell, relative to the cell containing position x, y.
+        xoffset and yoffset are arrays of cell offsets with the ionisation count of each,
+        missed is ionisation that already fell outside the cells. Cells that end up
+        outside the layer are added to the missed amount. primary is the incoming particle
+        the ionisation is recorded for when deposits are split by incoming particle.'''
+        count = np.asarray(count, dtype=float)
+        self._ionisation += count.sum() + missed
+        self._missed += missed
+        if self._response > 0 and self._lateral:
+            numcells = self._numcells
+            x0 = self._cell_index(np.array([x/self._cellsize]))[0]
+            y0 = self._cell_index(np.array([y/self._cellsize]))[0]
+            xcell = x0 + np.asarray(xoffset)
+            ycell = y0 + np.asarray(yoffset)
+            inside = ((xcell >= 0) & (xcell < numcells) & (ycell >= 0) & (ycell < numcells) &
+                      (x0 < numcells) & (y0 < numcells))
+            np.add.at(self._cells, (ycell[inside], xcell[inside]), count[inside])
+            if self._truth is not None and primary is not None:
+                np.add.at(self._truth[primary], (ycell[inside], xcell[inside]), count[inside])
+            self._missed += count[~inside].sum()
+
+    def free_steps(self, step):
+        '''Number of steps of length step up to and including the one in which a particle
+        interacts, drawn from the geometric distribution that the draws of interact give, one
+        per step with probability material*step.'''
+        material = self._material*step
+        if material <= 0:
+            return math.inf
+        if material >= 1:
+            return 1
+        return max(1, math.ceil(math.log(1.0 - self._pool.uniform())/math.log(1.0 - material)))
+
     def interact(self, particle, std, step):
         '''Let a particle interact (bremsstrahlung or pair production). The interaction
-        length is assumed to be the same for electrons and photons.'''
+        length is assumed to be the same for electrons and photons. The particle draws its
+        random numbers from the pool of the layer.'''
         material = self._material*step
         particles = [particle]
-        r = random.random()
+        r = self._pool.uniform()
 
         if r < material:
-            particles = particle.interact(std)
+            particles = particle.interact(std, self._pool)
 
         return particles
 
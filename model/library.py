@@ -0,0 +1,176 @@
+import copy
+import hashlib
+import os
+import numpy as np
+from . import rng
+from .cache import geometry, seed_key
+from .particle import Electron, Photon
+from .simulation import Simulation
+
+
+class ShowerLibrary:
+    '''A library of frozen sub-showers for low energy electrons and photons. Showers are
+    pre-simulated for each particle type, energy bin below threshold, starting volume of
+    a calorimeter and starting depth within that volume, on the grid of the steps of the
+    step engine. Only the occupied cells are stored, as offsets from the cell where the
+    shower started, together with the ionisation that missed the cells. During a
+    simulation a particle below threshold is replaced by a randomly drawn shower from its
+    bin, volume and nearest depth, moved to the particle's x and y and scaled from the
+    centre of the bin to its energy.'''
+
+    KINDS = ('elec', 'phot')
+    _PARTICLES = (Electron, Photon)
+    # Spacing of the starting depths, the step of Simulation
+    STEP = 0.1
+    # Increase whenever a change alters the libraries built, so cached ones are rebuilt
+    VERSION = 3
+
+    def __init__(self, threshold, std, edges, entries, depths, offsets, volume, dx, dy, count,
+                 layer_offsets, layer_volume, layer_missed):
+        self.threshold = threshold
+        self.std = std
+        self._edges = np.asarray(edges, dtype=float)
+        self._centres = 0.5*(self._edges[1:] + self._edges[:-1])
+        self._entries = int(entries)
+        # Number of starting depths of each volume, the first of volume v is _slots[v]
+        self._depths = np.asarray(depths, dtype=np.int64)
+        self._slots = np.concatenate(([0], np.cumsum(self._depths))).tolist()
+        # Cells of shower k are _volume[_offsets[k]:_offsets[k+1]] etc.
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+        self._volume = np.asarray(volume, dtype=np.int32)
+        self._dx = np.asarray(dx, dtype=np.int16)
+        self._dy = np.asarray(dy, dtype=np.int16)
+        self._count = np.asarray(count, dtype=np.float32)
+        # Missed ionisation per volume of shower k, likewise indexed by _layer_offsets
+        self._layer_offsets = np.asarray(layer_offsets, dtype=np.int64)
+        self._layer_volume = np.asarray(layer_volume, dtype=np.int32)
+        self._layer_missed = np.asarray(layer_missed, dtype=np.float32)
+
+    @property
+    def bins(self):
+        return len(self._edges) - 1
+
+    def _key(self, kind, b, volume, depth, entry):
+        slot = self._slots[volume] + depth
+        return ((kind*self.bins + b)*self._slots[-1] + slot)*self._entries + entry
+
+    @classmethod
+    def depths(cls, calorimeter):
+        '''Number of starting depths of each volume of a calorimeter, one per STEP of its
+        thickness and at least one.'''
+        return np.maximum(np.ceil(np.round(calorimeter._thickness/cls.STEP, 6)), 1).astype(np.int64)
+
+    @classmethod
+    def build(cls, calorimeter, std, threshold=0.5, bins=5, entries=20, engine='step', seed=None):
+        '''Simulate entries showers for each particle type, each of bins energy bins between
+        the cutoff of the particles and threshold, plus one bin below the cutoff, and each
+        starting depth of each volume of the calorimeter, see depths.
+        The showers are simulated with the given engine on a copy of the calorimeter. As every
+        volume has a starting depth per step this takes as long as simulating entries showers
+        from every step of the calorimeter.'''
+        cal = copy.deepcopy(calorimeter)
+        cal.use_random(rng.RandomPool(np.random.default_rng(seed)))
+        sim = Simulation(cal, engine=engine)
+        cutoff = max(p(0.0, 0.0, 0.0, 0.0, 0.0, 0.0).cutoff for p in cls._PARTICLES)
+        if threshold <= cutoff:
+            raise ValueError(f'The threshold has to be above the cutoff of the particles, {cutoff}')
+        edges = np.concatenate(([0.0], np.linspace(cutoff, threshold, bins + 1)))
+        centres = 0.5*(edges[1:] + edges[:-1])
+        depths = cls.depths(cal)
+        # Showers start in the centre of the middle cell of their volume, first[v, w] is the
+        # cell of layer w containing that position
+        centre = 0.5*cal._cellsize
+        first = np.array([[v.layer._cell_index(np.array([c/v.layer._cellsize]))[0]
+                           for v in cal._volumes] for c in centre])
+
+        offsets, volume, dx, dy, count = [0], [], [], [], []
+        layer_offsets, layer_volume, layer_missed = [0], [], []
+        for particle in cls._PARTICLES:
+            for energy in centres:
+                for v, start in enumerate(cal._volumes):
+                    for depth, entry in np.ndindex(depths[v], entries):
+                        missed = [w.layer._missed for w in cal._volumes]
+                        cal.reset()
+                        z = start.z + depth*cls.STEP
+                        sim._transport([particle(z, centre[v], centre[v], energy, 0.0, 0.0)], std)
+                        n = 0
+                        for w, vol in enumerate(cal._volumes):
+                            layer = vol.layer
+                            y, x = np.nonzero(layer._cells)
+                            volume.append(np.full(len(x), w))
+                            dx.append(x - first[v, w])
+                            dy.append(y - first[v, w])
+                            count.append(layer._cells[y, x])
+                            n += len(x)
+                            if layer._missed > missed[w]:
+                                layer_volume.append(w)
+                                layer_missed.append(layer._missed - missed[w])
+                        offsets.append(offsets[-1] + n)
+                        layer_offsets.append(len(layer_volume))
+
+        return cls(threshold, std, edges, entries, depths, offsets, np.concatenate(volume),
+                   np.concatenate(dx), np.concatenate(dy), np.concatenate(count),
+                   layer_offsets, layer_volume, layer_missed)
+
+    def replaces(self, particle):
+        '''Whether a particle is to be replaced by a library shower.'''
+        return particle.energy < self.threshold and particle.name in self.KINDS
+
+    def deposit(self, calorimeter, particle, index):
+        '''Deposit a random library shower in place of a particle in volume index, the one
+        starting nearest to the depth of the particle in the volume, scaled to its energy.'''
+        kind = self.KINDS.index(particle.name)
+        b = min(int(np.searchsorted(self._edges, particle.energy, side='right')) - 1, self.bins - 1)
+        volumes = calorimeter._volumes
+        depth = int(round((particle.z - volumes[index].z)/self.STEP))
+        depth = min(max(depth, 0), self._slots[index+1] - self._slots[index] - 1)
+        entry = int(calorimeter._pool.uniform()*self._entries)
+        key = self._key(kind, b, index, depth, entry)
+        # The shower was simulated at the centre of the bin, scale it to the energy. Below
+        # the cutoff, in the first bin, particles don't interact and the energy doesn't matter
+        scale = particle.energy/self._centres[b] if b > 0 else 1.0
+
+        a, e = self._offsets[key], self._offsets[key+1]
+        missed = dict(zip(self._layer_volume[self._layer_offsets[key]:self._layer_offsets[key+1]],
+                          self._layer_missed[self._layer_offsets[key]:self._layer_offsets[key+1]]))
+        if e > a:
+            cuts = np.flatnonzero(np.diff(self._volume[a:e])) + 1
+            for s, t in zip(np.concatenate(([0], cuts)) + a, np.concatenate((cuts, [e - a])) + a):
+                v = self._volume[s]
+                volumes[v].layer.deposit_cells(particle.x, particle.y, self._dx[s:t], self._dy[s:t],
+                                               scale*self._count[s:t], scale*missed.pop(v, 0.0),
+                                               particle.primary)
+        for v, miss in missed.items():
+            volumes[v].layer.deposit_cells(particle.x, particle.y, [], [], [], scale*miss, particle.primary)
+
+    def save(self, filename):
+        '''Write the library to a compressed NumPy file.'''
+        np.savez_compressed(filename, threshold=self.threshold, std=self.std, edges=self._edges,
+                            entries=self._entries, depths=self._depths, offsets=self._offsets,
+                            volume=self._volume, dx=self._dx, dy=self._dy, count=self._count,
+                            layer_offsets=self._layer_offsets, layer_volume=self._layer_volume,
+                            layer_missed=self._layer_missed)
+
+    @classmethod
+    def load(cls, filename):
+        '''Read a library written with save.'''
+        with np.load(filename) as f:
+            return cls(float(f['threshold']), float(f['std']), f['edges'], int(f['entries']),
+                       f['depths'], f['offsets'], f['volume'], f['dx'], f['dy'], f['count'],
+                       f['layer_offsets'], f['layer_volume'], f['layer_missed'])
+
+    @classmethod
+    def cached(cls, calorimeter, std, directory, threshold=0.5, bins=5, entries=20, engine='step',
+               seed=None):
+        '''Load the library for this geometry and these settings from directory, building and
+        saving it first if it isn't there yet.'''
+        settings = repr((geometry(calorimeter), cls.VERSION, None if std is None else float(std),
+                         float(threshold), int(bins), int(entries), engine,
+                         None if seed is None else seed_key(seed)))
+        name = 'library_' + hashlib.sha1(settings.encode()).hexdigest()[:16] + '.npz'
+        filename = os.path.join(directory, name)
+        if os.path.exists(filename):
+            return cls.load(filename)
+        library = cls.build(calorimeter, std, threshold, bins, entries, engine, seed)
+        library.save(filename)
+        return library
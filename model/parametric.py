@@ -0,0 +1,292 @@
+import numpy as np
+from scipy.special import gammainc, ndtr
+from . import rng
+from .particle import Electron
+
+
+def validation_report(full, fast, names=('full', 'fast')):
+    '''Compare the per layer ionisation of two sets of runs, each an array (runs, layers) as
+    returned by simulate. Returns a text table with the mean and spread of every layer and
+    the relative difference of the means.'''
+    lines = [f'{"layer":>5} {names[0]+" mean":>12} {names[0]+" std":>12} '
+             f'{names[1]+" mean":>12} {names[1]+" std":>12} {"rel diff":>9}']
+    for l, (m1, s1, m2, s2) in enumerate(zip(full.mean(0), full.std(0), fast.mean(0), fast.std(0))):
+        diff = (m2 - m1)/m1 if m1 > 0 else 0.0
+        lines.append(f'{l:5d} {m1:12.3f} {s1:12.3f} {m2:12.3f} {s2:12.3f} {diff:9.3f}')
+    t1, t2 = full.sum(1), fast.sum(1)
+    lines.append(f'{"total":>5} {t1.mean():12.3f} {t1.std():12.3f} {t2.mean():12.3f} {t2.std():12.3f} '
+                 f'{(t2.mean() - t1.mean())/t1.mean() if t1.mean() > 0 else 0.0:9.3f}')
+    return '\n'.join(lines)
+
+
+def mean_pulls(full, fast):
+    '''Difference of the means of fast and full along the first axis, in units of its
+    standard error. Entries without any spread count as agreeing.'''
+    error = np.sqrt(full.var(0, ddof=1)/len(full) + fast.var(0, ddof=1)/len(fast))
+    return np.divide(fast.mean(0) - full.mean(0), error, out=np.zeros_like(error), where=error > 0)
+
+
+def spread_pulls(full, fast):
+    '''Difference of the standard deviations of fast and full along the first axis, in
+    units of its standard error. The error of each comes from the fourth moment, as the
+    deposits of the last layers are far from normal.'''
+    def error(values):
+        std = values.std(0)
+        m4 = ((values - values.mean(0))**4).mean(0)
+        return np.divide(np.sqrt(np.maximum(m4 - std**4, 0)/len(values)), 2*std,
+                         out=np.zeros_like(std), where=std > 0)
+    s1, s2 = full.std(0), fast.std(0)
+    total = np.sqrt(error(full)**2 + error(fast)**2)
+    return np.divide(s2 - s1, total, out=np.zeros_like(total), where=total > 0)
+
+
+def validation_failures(full, fast, limit=3.0):
+    '''Check what validation_report shows: the mean and spread of the total and of every
+    layer of fast have to agree with full within limit standard errors. With many layers a
+    few are expected beyond limit by chance, so up to 5% of the layers plus one may be.
+    Returns a list describing the checks that fail, empty if all pass.'''
+    full = np.asarray(full, dtype=float)
+    fast = np.asarray(fast, dtype=float)
+    total = full.sum(1)[:, np.newaxis], fast.sum(1)[:, np.newaxis]
+    allowed = int(0.05*full.shape[1]) + 1
+    failures = []
+    for name, pulls, allow in (('total mean', mean_pulls(*total), 0),
+                               ('total spread', spread_pulls(*total), 0),
+                               ('layer means', mean_pulls(full, fast), allowed),
+                               ('layer spreads', spread_pulls(full, fast), allowed)):
+        beyond = np.flatnonzero(np.abs(pulls) > limit)
+        if len(beyond) > allow:
+            failures.append(f'{name} differ by more than {limit} standard errors in '
+                            f'{len(beyond)} places, up to {np.abs(pulls).max():.1f}')
+    return failures
+
+
+class ParametricSimulation:
+    '''A fast parametric stand in for Simulation. For every fitted energy the longitudinal
+    profile of a shower is described by a gamma function in the depth t (counted in active
+    layers), with the total ionisation and the mean and variance of t drawn together from a
+    multivariate normal fitted to the runs, truncated to positive values, and a correction
+    per layer for the mean profile. The lateral profile of each layer is a Gaussian around
+    the entry point with a fitted width.
+
+    The first layers hardly depend on the shape of the shower, so each layer follows the
+    drawn profile only by a fitted coupling and the mean profile otherwise. The rest of the
+    spread of each layer comes from sharing the total ionisation over the layers in clusters
+    of a fitted size per layer, like the deposits of single particles crossing the layer,
+    and the clusters of each layer over its cells. Coupling and cluster size are chosen so
+    the spread of every layer matches the runs. Parameters are interpolated linearly
+    between fitted energies.'''
+
+    def __init__(self, calorimeter):
+        self._calorimeter = calorimeter
+        self._layers = [v.layer for v in calorimeter._volumes if v.layer._yield > 0]
+        self._energies = []
+        self._params = []
+
+    def fit(self, energy, ionisations, cells, x=0.0, y=0.0):
+        '''Fit the parameters for one energy from the output of Simulation.simulate for
+        particles entering at x, y.'''
+        ionisations = np.asarray(ionisations, dtype=float)
+        cells = np.asarray(cells, dtype=float)
+        nlayers = ionisations.shape[1]
+        depth = np.arange(nlayers) + 0.5
+        total = ionisations.sum(1)
+        showers = total > 0
+        positive = cells[cells > 0]
+        quantum = positive.min() if len(positive) else 1.0
+
+        deposits = ionisations[showers]
+        tot = total[showers]
+        weights = deposits/tot[:, np.newaxis]
+        tmean = (weights*depth).sum(1)
+        tvar = (weights*(depth - tmean[:, np.newaxis])**2).sum(1)
+        sample = np.stack((tot, tmean, tvar), axis=1)
+        mean = sample.mean(0) if len(sample) else np.zeros(3)
+        cov = np.cov(sample, rowvar=False) if len(sample) > 1 else np.zeros((3, 3))
+        deposit = deposits.mean(0) if len(deposits) else np.zeros(nlayers)
+        fraction = self._normalise(deposit[np.newaxis])[0]
+        draws, correction, shapes = self._match(mean, cov, fraction)
+        coupling = np.zeros(nlayers)
+        cluster = np.full(nlayers, quantum)
+        if len(draws):
+            # Clusters of one quantum already give this much spread, the shape of the shower
+            # may give at most the rest and the clusters make up what is missing after that
+            var = deposits.var(0)
+            counted = deposit*(1.0 - fraction)
+            for i in range(3):
+                coupling = self._fit_coupling(draws[:, 0], shapes, fraction, coupling,
+                                              var - quantum*counted)
+            shape_var = (draws[:, :1]*self._blend(shapes, fraction, coupling)).var(0)
+            size = np.divide(var - shape_var, counted, out=np.zeros(nlayers), where=counted > 0)
+            cluster = quantum*np.maximum(np.rint(size/quantum), 1.0)
+
+        sigma = np.full(len(self._layers), np.nan)
+        mean_cells = cells.mean(0)
+        for l, layer in enumerate(self._layers):
+            w = mean_cells[l]
+            if w.sum() <= 0:
+                continue
+            mid = int(np.floor(layer._numcells/2))
+            centres = (np.arange(layer._numcells) - mid + 0.5)*layer._cellsize
+            var_x = (w.sum(0)*(centres - x)**2).sum()/w.sum()
+            var_y = (w.sum(1)*(centres - y)**2).sum()/w.sum()
+            # Remove the spread that comes from the size of the cells
+            sigma[l] = np.sqrt(max(0.5*(var_x + var_y) - layer._cellsize**2/12, 1e-6))
+        known = ~np.isnan(sigma)
+        if np.any(known):
+            sigma = np.interp(np.arange(len(sigma)), np.flatnonzero(known), sigma[known])
+        else:
+            sigma[:] = 0.0
+
+        params = {'empty': 1.0 - showers.mean(), 'mean': mean, 'cov': cov, 'sigma': sigma,
+                  'deposit': deposit, 'correction': correction, 'coupling': coupling,
+                  'cluster': cluster}
+        i = int(np.searchsorted(self._energies, energy))
+        self._energies.insert(i, energy)
+        self._params.insert(i, params)
+
+    def _match(self, mean, cov, fraction):
+        '''Draws of the total and the depth for these parameters, positive ones only, from a
+        fixed stream so fits are reproducible, the correction per layer that makes the mean of
+        their gamma functions follow fraction, since a gamma function doesn't follow the start
+        of the showers well, and the corrected profiles.'''
+        correction = np.ones(len(fraction))
+        if not (mean > 0).all():
+            return np.zeros((0, 3)), correction, np.zeros((0, len(fraction)))
+        draws = self._draw(np.random.default_rng(0), mean, cov, 20000)
+        draws = draws[(draws > 0).all(1)]
+        profiles = self._profiles(draws[:, 1], draws[:, 2], len(fraction))
+        for i in range(20):
+            model = self._normalise(profiles*correction).mean(0)
+            correction *= np.where(model > 0, fraction/np.where(model > 0, model, 1.0), 1.0)
+        return draws, correction, self._normalise(profiles*correction)
+
+    @staticmethod
+    def _draw(generator, mean, cov, number):
+        '''Draw number totals and means and variances of the depth from the multivariate
+        normal, truncated to positive means and variances by drawing again. Draws that still
+        aren't positive after a number of tries, which only happens for a degenerate fit, are
+        returned as they are.'''
+        draws = generator.multivariate_normal(mean, cov, number)
+        for i in range(100):
+            invalid = (draws[:, 1:] <= 0).any(1)
+            if not invalid.any():
+                break
+            draws[invalid] = generator.multivariate_normal(mean, cov, invalid.sum())
+        return draws
+
+    @staticmethod
+    def _blend(shapes, fraction, coupling):
+        '''Fraction of the ionisation in each layer following each row of shapes by coupling
+        and the mean fraction otherwise. The deviations from the mean are taken off all
+        layers in proportion to their mean fraction, so the rows still add up to one apart
+        from clipping at zero.'''
+        deviation = coupling*(shapes - fraction)
+        return np.maximum(fraction + deviation - fraction*deviation.sum(1, keepdims=True), 0.0)
+
+    @staticmethod
+    def _fit_coupling(total, shapes, fraction, coupling, target):
+        '''The largest coupling of each layer, in steps of 0.05, for which the variance of
+        its ionisation with the given totals stays within target, with the other layers
+        keeping the given coupling.'''
+        deviation = coupling*(shapes - fraction)
+        others = deviation.sum(1, keepdims=True) - deviation
+        best = np.zeros(len(fraction))
+        for c in np.linspace(0.0, 1.0, 21):
+            own = c*(shapes - fraction)
+            layer = np.maximum(fraction + own - fraction*(others + own), 0.0)
+            best = np.where((total[:, np.newaxis]*layer).var(0) <= target, c, best)
+        return best
+
+    @staticmethod
+    def _profiles(tmean, tvar, nlayers):
+        '''Fraction of the ionisation in each layer for gamma functions with the given means
+        and variances of the depth, normalised over the layers.'''
+        tmean = np.asarray(tmean, dtype=float)[:, np.newaxis]
+        tvar = np.maximum(np.asarray(tvar, dtype=float), 1e-3)[:, np.newaxis]
+        fractions = np.diff(gammainc(tmean**2/tvar, tmean/tvar*np.arange(nlayers + 1)), axis=1)
+        return ParametricSimulation._normalise(fractions)
+
+    @staticmethod
+    def _normalise(fractions):
+        '''Scale each row of fractions to add up to one, leaving rows of zeros alone.'''
+        norm = fractions.sum(1, keepdims=True)
+        return np.where(norm > 0, fractions/np.where(norm > 0, norm, 1.0), 0.0)
+
+    def _cell_probabilities(self, params, x, y):
+        '''Probability for a quantum in each layer to end up in each cell for a shower entering
+        at x, y, with a last column for the quanta outside the cells.'''
+        probs = []
+        for layer, sigma in zip(self._layers, params['sigma']):
+            mid = int(np.floor(layer._numcells/2))
+            edges = (np.arange(layer._numcells + 1) - mid)*layer._cellsize
+            px = np.diff(ndtr((edges - x)/sigma)) if sigma > 0 else np.histogram([x], edges)[0]
+            py = np.diff(ndtr((edges - y)/sigma)) if sigma > 0 else np.histogram([y], edges)[0]
+            p = np.outer(py, px).ravel()
+            probs.append(np.append(p, max(1.0 - p.sum(), 0.0)))
+        probs = np.array(probs)
+        return probs/probs.sum(1, keepdims=True)
+
+    @classmethod
+    def from_simulation(cls, simulation, energies, std, number, x=0.0, y=0.0, seed=None):
+        '''Fit the parameters at every energy from number runs of a full simulation of electrons
+        entering at x, y.'''
+        parametric = cls(simulation._calorimeter)
+        seeds = np.random.SeedSequence(seed).spawn(len(energies))
+        for energy, s in zip(energies, seeds):
+            ionisations, cells = simulation.simulate(Electron(0.0, x, y, energy, 0, 0), std, number, seed=s)
+            parametric.fit(energy, ionisations, cells, x, y)
+        return parametric
+
+    def _parameters(self, energy):
+        '''The parameters at an energy, linearly interpolated between the fitted energies.'''
+        if not self._energies:
+            raise ValueError('No energies have been fitted yet')
+        i = int(np.searchsorted(self._energies, energy))
+        if i == 0 or i == len(self._energies):
+            return self._params[min(i, len(self._energies) - 1)]
+        e1, e2 = self._energies[i-1], self._energies[i]
+        f = (energy - e1)/(e2 - e1)
+        p1, p2 = self._params[i-1], self._params[i]
+        return {k: (1 - f)*p1[k] + f*p2[k] for k in p1}
+
+    def simulate(self, particle, std, number, seed=None):
+        '''Sample number showers of the incoming particle. Takes the same arguments and
+        returns the same arrays as Simulation.simulate. std is not used, the lateral spread
+        is the fitted one.'''
+        params = self._parameters(particle.energy)
+        generator = rng.get_pool().generator if seed is None else np.random.default_rng(seed)
+        nlayers = len(self._layers)
+        numcells = self._layers[0]._numcells
+
+        draws = self._draw(generator, params['mean'], params['cov'], number)
+        showers = (generator.random(number) >= params['empty']) & (draws > 0).all(1)
+        shapes = np.zeros((number, nlayers))
+        shapes[showers] = self._profiles(draws[showers, 1], draws[showers, 2], nlayers)
+        shapes = self._normalise(shapes*params['correction'])
+        showers &= shapes.sum(1) > 0
+
+        # Expected number of clusters in each layer, shared out keeping their total
+        fraction = self._normalise(params['deposit'][np.newaxis])[0]
+        expected = (draws[showers, :1]*self._blend(shapes[showers], fraction, params['coupling'])
+                    /params['cluster'])
+        clusters = np.zeros((number, nlayers), dtype=np.int64)
+        clusters[showers] = generator.multinomial(np.rint(expected.sum(1)).astype(np.int64),
+                                                  self._normalise(expected))
+        counts = generator.multinomial(clusters, self._cell_probabilities(params, particle.x, particle.y))
+
+        # The clusters differ in size between layers, so the ionisation is scaled back to the
+        # drawn total
+        deposited = (clusters*params['cluster']).sum(1)
+        scale = np.divide(draws[:, 0], deposited, out=np.zeros(number), where=showers & (deposited > 0))
+        unit = params['cluster']*scale[:, np.newaxis]
+        ionisations = clusters*unit
+        cells = (counts[:, :, :-1]*unit[:, :, np.newaxis]).reshape(number, nlayers, numcells, numcells)
+        return ionisations, cells
+
+    def validate(self, simulation, particle, std, number, seed=None):
+        '''Run the full simulation and the parametric one for the same particle and return a
+        validation_report comparing them.'''
+        full, _ = simulation.simulate(particle, std, number, seed=seed)
+        fast, _ = self.simulate(particle, std, number, seed=seed)
+        return validation_report(full, fast)
@@ -1,10 +1,14 @@
-import random
 import numpy as np
 import csv
+from . import rng
 
 
 class Particle:
-    '''Base class for particles'''
+    '''Base class for particles. primary is the index of the incoming particle a particle
+    descends from, when deposits are recorded per incoming particle. When interact is called
+    with std None no lateral offsets are drawn, the new particles start where their parent is.'''
+
+    primary = None
 
     def __init__(self, name, z, x, y, energy, ionise, cutoff, xangle, yangle):
         self.name = name
@@ -26,11 +30,12 @@ class Particle:
         The base class particle doesn't interact at all'''
         return [self]
 
-    def offset(self, std):
-        offset_val1 = np.random.multivariate_normal((0.0, 0.0), [[std, 0], [0, std]])
-        offset_val2 = np.random.multivariate_normal((0.0, 0.0), [[std, 0], [0, std]])
-        # print('Offset =', offset)
-        return offset_val1, offset_val2
+    def offset(self, std, pool=None):
+        '''Two independent offsets in x and y, each normal with variance std, drawn from
+        pool, a RandomPool, or the shared one of rng if it is None.'''
+        scale = np.sqrt(std)
+        n = (rng.get_pool() if pool is None else pool).normal(4)
+        return (scale*n[0], scale*n[1]), (scale*n[2], scale*n[3])
 
     def __str__(self):
         return f'{self.name:10} z:{self.z:.3f} x:{self.x:.3f} y:{self.y:.3f} E:{self.energy:.3f}'
@@ -41,19 +46,27 @@ class Electron(Particle):
     def __init__(self, z, x, y, energy, xangle, yangle):
         super(Electron, self).__init__('elec', z, x, y, energy, True, 0.01, xangle, yangle)
 
-    def interact(self, std):
-        '''An electron radiates xangle photon. Make the energy split evenly.'''
+    def interact(self, std, pool=None):
+        '''An electron radiates xangle photon. Make the energy split evenly. The random
+        numbers come from pool, normally that of the layer it interacts in.'''
         particles = []
 
         if self.energy > self.cutoff:
 
-            split = random.random()
-            new1, new2 = self.offset(std)
+            pool = rng.get_pool() if pool is None else pool
+            split = pool.uniform()
+            if std is None:
+                new1 = new2 = (0.0, 0.0)
+            else:
+                new1, new2 = self.offset(std, pool)
             xangle = self.xangle
             yangle = self.yangle
 
             particles = [Electron(self.z, self.x + new1[0] + xangle, self.y + new1[1] + yangle, split*self.energy, xangle, yangle), Photon(self.z, self.x + new2[0] + xangle,
                             self.y + new2[1] + yangle, (1.0-split)*self.energy, xangle, yangle)]
+            if self.primary is not None:
+                for p in particles:
+                    p.primary = self.primary
         return particles
 
 
@@ -62,18 +75,26 @@ class Photon(Particle):
     def __init__(self, z, x, y, energy, xangle, yangle):
         super(Photon, self).__init__('phot', z, x, y, energy, False, 0.01, xangle, yangle)
 
-    def interact(self, std):
-        '''A photon splits into an electron and xangle positron. Make the energy split randomly.'''
+    def interact(self, std, pool=None):
+        '''A photon splits into an electron and xangle positron. Make the energy split randomly.
+        The random numbers come from pool, normally that of the layer it interacts in.'''
         particles = []
         if self.energy > self.cutoff:
 
-            split = random.random()
-            new1, new2 = self.offset(std)
+            pool = rng.get_pool() if pool is None else pool
+            split = pool.uniform()
+            if std is None:
+                new1 = new2 = (0.0, 0.0)
+            else:
+                new1, new2 = self.offset(std, pool)
             xangle = self.xangle
             yangle = self.yangle
 
             particles = [Electron(self.z, self.x + new1[0] + xangle, self.y + new1[1] + yangle, split*self.energy, xangle, yangle), Electron(self.z, self.x + new2[0] + xangle,
                             self.y + new2[1] + yangle, (1.0-split)*self.energy, xangle, yangle)]
+            if self.primary is not None:
+                for p in particles:
+                    p.primary = self.primary
 
         return particles
 
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+class RandomPool:
+    '''Hands out random numbers from blocks generated in bulk. Drawing a single number
+    from NumPy has a large overhead, so standard normals and uniforms are generated
+    block numbers at a time and handed out one by one until the block is used up.'''
+
+    def __init__(self, generator=None, block=8192):
+        self._generator = np.random.default_rng() if generator is None else generator
+        self._block = block
+        self._normals = []
+        self._uniforms = []
+
+    @property
+    def generator(self):
+        '''The underlying NumPy generator, for drawing whole arrays at once.'''
+        return self._generator
+
+    def normal(self, n):
+        '''Return a list of n independent standard normal numbers.'''
+        if len(self._normals) < n:
+            self._normals = self._generator.standard_normal(max(self._block, n)).tolist()
+        values = self._normals[-n:]
+        del self._normals[-n:]
+        return values
+
+    def uniform(self):
+        '''Return a single uniform number in [0, 1).'''
+        if not self._uniforms:
+            self._uniforms = self._generator.random(self._block).tolist()
+        return self._uniforms.pop()
+
+
+_pool = RandomPool()
+
+
+def get_pool():
+    '''The shared random pool, used by layers and particles outside a calorimeter and by
+    anything else without a pool of its own. Calorimeters have their own, see
+    Calorimeter.use_random.'''
+    return _pool
+
+
+def seed(value=None):
+    '''Replace the shared random pool by one seeded with value, which can be anything
+    numpy.random.default_rng takes, including a SeedSequence or a Generator to draw from.'''
+    global _pool
+    _pool = RandomPool(np.random.default_rng(value))
+    return _pool
+
+
+def event_seed(seed, *index):
+    '''The SeedSequence spawned from seed at the position given by index, without spawning
+    from seed itself. event_seed(seed, i) is the seed of event i of a simulation with seed and
+    event_seed(seed, j, i) that of event i of point j of a campaign, so any single event can
+    be simulated again on its own.'''
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + index,
+                                  pool_size=seed.pool_size)
@@ -1,62 +1,400 @@
 import copy
+import warnings
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from . import rng
+from . import compiled
+from .engine import VectorEngine
+from .instrument import Instrumentation
+from .sparse import SparseHits
+
+
+def _simulate_events(simulation, particle, std, seeds, sparse, lateral):
+    '''Run the events with the given seeds in a worker process. The simulation arrives
+    as a pickled copy, so each worker owns its calorimeter.'''
+    return simulation._run_events(particle, std, seeds, sparse, lateral)
+
 
 class Simulation:
     '''A simulation is defined by a calorimeter. Then individual simulation runs can be created by
-    running the same particle through the calorimter multiple times.'''
-    def __init__(self, calorimeter):
+    running the same particle through the calorimter multiple times. The engine is either 'step',
+    where particle objects are stepped one by one, 'vector', where the whole shower is kept in
+    arrays and stepped at once, 'freepath', where each particle jumps straight to its next
+    interaction or layer boundary (see Calorimeter.transport), 'compiled', where a whole
+    event runs in one Numba compiled loop, 'batch', where all events of a call are kept
+    in one population as for 'vector' (see simulate_batch), or 'stack', where the particles
+    are stepped as for 'step' but depth first, one at a time (see _transport_stack). Without
+    Numba 'compiled' falls back to 'step'.
+
+    Particles are dropped once they leave the back of the calorimeter or their energy falls
+    below energy_floor, and a run stops as soon as no particle is left. After each call to
+    simulate, iterations_run and iterations_saved hold for every run the number of steps
+    taken and the number skipped out of the maximum of ITERATIONS, particle_steps the number
+    of steps of all particles together, which measures the work of a run the same way for
+    every engine ('freepath' counts the steps it jumps over), peak_particles the largest
+    number of particles held at once (the whole batch for 'batch', not recorded and zero for
+    'freepath' and instrumented runs), and seed the master seed the random streams of the
+    events were derived from.
+
+    With a ShowerLibrary, electrons and photons falling below its threshold are not followed
+    any further but replaced by a frozen shower from the library (not for the vector engine).
+
+    Counters of what happens in each iteration can be switched on with instrument. Studies
+    that only need the ionisation of each layer can pass lateral=False to the simulate
+    methods: the particles then get no lateral offsets and no cells are recorded.'''
+
+    ENGINES = ('step', 'vector', 'freepath', 'compiled', 'batch', 'stack')
+    ITERATIONS = 1000
+    # Increase whenever a change alters the results for a given seed, so cached results
+    # of older versions (see ResultCache) are no longer used
+    VERSION = 3
+
+    def __init__(self, calorimeter, engine='step', energy_floor=0.0, library=None):
+        if engine not in self.ENGINES:
+            raise ValueError(f'Unknown engine {engine}, choose one of {self.ENGINES}')
+        if engine == 'compiled' and not compiled.AVAILABLE:
+            warnings.warn('numba is not installed, using the step engine instead of the compiled one')
+            engine = 'step'
+        if library is not None and engine in ('vector', 'compiled', 'batch'):
+            raise ValueError(f'A shower library can not be used with the {engine} engine')
         self._calorimeter = calorimeter
+        self._engine = engine
+        self._energy_floor = energy_floor
+        self._library = library
+        self._vector = VectorEngine(calorimeter)
+        self._compiled = compiled.CompiledEngine(calorimeter) if engine == 'compiled' else None
+        self.iterations_run = np.zeros(0, dtype=int)
+        self.iterations_saved = np.zeros(0, dtype=int)
+        self.peak_particles = np.zeros(0, dtype=int)
+        self.particle_steps = np.zeros(0, dtype=int)
+        self._peak = 0
+        self._moved = 0
+        self.instrumentation = None
+        self.seed = None
+        self._pool = calorimeter._pool
+
+    def use_random(self, pool):
+        '''Draw the random numbers of the following events from pool, a RandomPool, which is
+        handed on to the calorimeter, see Calorimeter.use_random. Events with a seed get a
+        pool of their own seeded with it.'''
+        self._pool = pool
+        self._calorimeter.use_random(pool)
+
+    def instrument(self, enable=True):
+        '''Record counters and timings of every iteration in an Instrumentation, which is
+        returned and kept in instrumentation until instrument(False) is called. Only for the
+        step engine in a single process. Without it nothing is recorded or checked per step.'''
+        if not enable:
+            self.instrumentation = None
+            return None
+        if self._engine != 'step':
+            raise ValueError(f'Instrumentation is not available for the {self._engine} engine')
+        self.instrumentation = Instrumentation(self._calorimeter)
+        return self.instrumentation
+
+    def _transport(self, particles, std):
+        '''Transport a list of incoming particles and their showers through the calorimeter
+        in one pass. Returns the number of steps taken, the largest number of particles held
+        at once is kept in _peak and the steps of all particles together in _moved.'''
+        if self._library is not None and std is not None and self._library.std != std:
+            raise ValueError(f'The shower library was built for std {self._library.std}, not {std}')
+        self._peak = 0
+        self._moved = 0
+        if self._engine in ('vector', 'batch'):
+            iter = self._vector.run(particles, std, 0.1, self.ITERATIONS, self._energy_floor)
+            self._peak = self._vector.peak
+            self._moved = self._vector.moved
+            return iter
+        if self._engine == 'compiled':
+            iter = self._compiled.run(particles, std, 0.1, self.ITERATIONS, self._energy_floor)
+            self._peak = self._compiled.peak
+            self._moved = self._compiled.moved
+            return iter
+        if self._engine == 'stack':
+            return self._transport_stack(particles, std)
+        if self._engine == 'freepath':
+            chains = [self._calorimeter.transport(copy.copy(p), std, self.ITERATIONS, 0.1,
+                                                  self._energy_floor, self._library)
+                      for p in particles]
+            self._moved = sum(moved for _, moved in chains)
+            return max(longest for longest, _ in chains)
+
+        zend = self._calorimeter._zend
+        particles = [copy.copy(p) for p in particles]
+        if self.instrumentation is not None:
+            return self.instrumentation.transport(self, particles, std)
+        iter = 0
+        while iter < self.ITERATIONS and particles:
+            self._peak = max(self._peak, len(particles))
+            self._moved += len(particles)
+            next = []
+            for p in particles:
+                newparticles = self._calorimeter.step(p, std, 0.1)
+                next.extend(newparticles)
+            # Nothing can happen any more to particles behind the calorimeter
+            particles = [p for p in next if p.z < zend and p.energy >= self._energy_floor]
+            if self._library is not None:
+                particles = [p for p in particles if not self._substitute(p)]
+            iter += 1
+        return iter
+
+    def _transport_stack(self, particles, std):
+        '''Step the particles as the step engine does, but depth first: a particle is stepped
+        until it interacts or is dropped, then its secondaries are put on a stack and the
+        last one is followed next. Only the particles on the stack are held at once, about one
+        per generation of the shower, instead of a whole generation, so memory stays small
+        for any energy. Each particle remembers its step, so the same ITERATIONS limit applies.
+        Returns the steps of the longest chain, which is what the step engine takes.'''
+        cal = self._calorimeter
+        locate = cal.locate
+        volumes = cal._volumes
+        zend = cal._zend
+        floor = self._energy_floor
+        library = self._library
+        stack = [(copy.copy(p), 0) for p in reversed(particles)]
+        peak = len(stack)
+        longest = moved = 0
+        while stack:
+            p, iter = stack.pop()
+            first = iter
+            while iter < self.ITERATIONS:
+                # A step as in Calorimeter.step
+                index = locate(p.z)
+                p.move(0.1)
+                iter += 1
+                if index >= 0:
+                    layer = volumes[index].layer
+                    layer.ionise(p, 0.1)
+                    newparticles = layer.interact(p, std, 0.1)
+                    if len(newparticles) != 1 or newparticles[0] is not p:
+                        for q in reversed(newparticles):
+                            if q.z < zend and q.energy >= floor and (library is None or not self._substitute(q)):
+                                stack.append((q, iter))
+                        peak = max(peak, len(stack))
+                        break
+                if p.z >= zend or p.energy < floor or (library is not None and self._substitute(p)):
+                    break
+            longest = max(longest, iter)
+            moved += iter - first
+        self._peak = peak
+        self._moved = moved
+        return longest
+
+    def _substitute(self, particle):
+        '''Deposit a library shower in place of the particle if it is below the library
+        threshold and inside a volume. Returns whether it was replaced.'''
+        if not self._library.replaces(particle):
+            return False
+        index = self._calorimeter.locate(particle.z)
+        if index < 0:
+            return False
+        self._library.deposit(self._calorimeter, particle, index)
+        return True
 
-    def simulate(self, particle, std, number):
+    def _record_iterations(self, iterations):
+        '''Keep the steps, peak number of particles and steps of all particles of each event,
+        given as triples.'''
+        counts = np.array(iterations, dtype=int).reshape(-1, 3)
+        self.iterations_run = counts[:, 0]
+        self.iterations_saved = self.ITERATIONS - self.iterations_run
+        self.peak_particles = counts[:, 1]
+        self.particle_steps = counts[:, 2]
+
+    def _longitudinal(self, run, particles, std, *args):
+        '''Call run(particles, std, *args) without lateral offsets (std None) and with the
+        calorimeter only recording the ionisation of each layer.'''
+        cal = self._calorimeter
+        cal.track_cells(False)
+        try:
+            return run(particles, None, *args)
+        finally:
+            cal.track_cells(True)
+
+    def _run_events(self, particle, std, seeds, sparse=False, lateral=True):
+        '''Simulate one event for each entry of seeds. An event with a seed other than None
+        draws its random numbers from a stream seeded with it. The ionisations and cells are
+        written straight into arrays for all events, or with sparse the cells of the events
+        are returned as SparseHits. Without lateral the cells are None.'''
+        if not lateral:
+            return self._longitudinal(self._run_events, particle, std, seeds, sparse)
+        if self._engine == 'batch':
+            return self._run_batch([particle]*len(seeds), std, seeds[0] if seeds else None, sparse)
+        cal = self._calorimeter
+        ionisations = np.zeros((len(seeds), len(cal._active)))
+        if not cal._lateral:
+            ions_layers = None
+        elif sparse:
+            ions_layers = []
+        else:
+            ions_layers = np.zeros((len(seeds),) + cal.cells_shape())
+        iterations = []
+
+        for i, seed in enumerate(seeds):
+
+            if seed is not None:
+                self.use_random(rng.RandomPool(np.random.default_rng(seed)))
+            cal.reset()
+            iterations.append((self._transport([particle], std), self._peak, self._moved))
+
+            ionisations[i] = cal.ionisations()
+            if ions_layers is None:
+                continue
+            if sparse:
+                ions_layers.append(SparseHits.from_dense(cal.ions_by_layer()[np.newaxis]))
+            else:
+                cal.ions_by_layer(out=ions_layers[i])
+
+        if sparse and ions_layers is not None:
+            ions_layers = SparseHits.concatenate(ions_layers, cal.cells_shape())
+        return ionisations, ions_layers, iterations
+
+    def _run_batch(self, particles, std, seed, sparse=False, lateral=True):
+        '''Transport one event for each of the particles in a single batch, drawing from a
+        stream seeded with seed if it isn't None. Returns the same as _run_events.'''
+        if not lateral:
+            return self._longitudinal(self._run_batch, particles, std, seed, sparse)
+        if seed is not None:
+            self.use_random(rng.RandomPool(np.random.default_rng(seed)))
+        ionisations, ions_layers, iterations = self._vector.run_batch(
+            particles, std, 0.1, self.ITERATIONS, self._energy_floor)
+        ionisations = ionisations[:, self._calorimeter._active]
+        if sparse and ions_layers is not None:
+            ions_layers = SparseHits.from_dense(ions_layers)
+        return ionisations, ions_layers, [(i, self._vector.peak, m)
+                                          for i, m in zip(iterations, self._vector.moved)]
+
+    def _event_seeds(self, number, seed):
+        '''One seed per event derived from the master seed, see rng.event_seed. Without a seed
+        a new master seed is drawn. The master seed is kept in seed.'''
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed = seed
+        return [rng.event_seed(seed, i) for i in range(number)]
+
+    def simulate(self, particle, std, number, workers=1, seed=None, sparse=False, lateral=True):
         '''Run a individual simulation. The ingoing particle is simulated going
         through the calorimeter "number" times. A 2D array is returned with the
         first axis the ionisation in the individual layers and the second corresponding to each
-        new particle.'''
-        ionisations = []
-        ions_layers = []
-
-        for i in range(number):
-
-            self._calorimeter.reset()
-            particles = [copy.copy(particle)]
-            offvals = []
-            iter = 0
-            while iter < 1000:
-                next = []
-                for p in particles:
-                    newparticles = self._calorimeter.step(p, std, 0.1)
-                    next.extend(newparticles)
-                particles = next
-                iter += 1
+        new particle.
+
+        With workers > 1 the events are shared out in fixed chunks to a pool of processes,
+        each with its own copy of the calorimeter. Every event gets its own random stream
+        derived from the master seed, so for a given seed the result is the same whatever
+        the number of workers (the batch engine, whose events depend on their grouping, runs
+        in a single process only). The seed can be an integer or a SeedSequence. Without one a
+        new master seed is drawn, it is kept in seed afterwards and any event can be
+        simulated again on its own with simulate_again.
 
-            ionisations.append(self._calorimeter.ionisations())
-            ions_layers.append(self._calorimeter.ions_by_layer())
+        With sparse=True the cells are returned as SparseHits instead of a dense array, and
+        only the occupied cells of each event are kept while the simulation runs. With
+        lateral=False only the ionisations are simulated and None is returned for the cells.'''
+        seeds = self._event_seeds(number, seed)
+        if workers > 1 and self.instrumentation is not None:
+            raise ValueError('Instrumented simulations run in a single process only')
+        if workers > 1 and self._engine == 'batch':
+            raise ValueError('The batch engine runs in a single process only, its events depend '
+                             'on how they are divided up')
 
-        allionisations = np.stack(ionisations, axis=0)
-        allionsbycells = np.stack(ions_layers, axis=0)
+        if workers > 1:
+            cal = self._calorimeter
+            allionisations = np.zeros((number, len(cal._active)))
+            if not lateral:
+                allionsbycells = None
+            elif sparse:
+                allionsbycells = []
+            else:
+                allionsbycells = np.zeros((number,) + cal.cells_shape())
+            iterations = []
+            bounds = np.linspace(0, number, workers + 1).astype(int)
+            chunks = [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_simulate_events, self, particle, std, seeds[a:b], sparse, lateral)
+                           for a, b in chunks]
+                for (a, b), future in zip(chunks, futures):
+                    ions, cells, iters = future.result()
+                    allionisations[a:b] = ions
+                    if sparse and lateral:
+                        allionsbycells.append(cells)
+                    elif lateral:
+                        allionsbycells[a:b] = cells
+                    iterations.extend(iters)
+            if sparse and lateral:
+                allionsbycells = SparseHits.concatenate(allionsbycells)
+        else:
+            allionisations, allionsbycells, iterations = self._run_events(particle, std, seeds, sparse, lateral)
+
+        self._record_iterations(iterations)
         return allionisations, allionsbycells
 
-    def simulate_multiple(self, particles_list, std, numlayers, numcells):
+    def simulate_blocks(self, particle, std, number, block=100, seed=None, sparse=False, start=0,
+                        lateral=True):
+        '''Same as simulate in a single process, but the events are handed out in blocks of
+        at most block events as soon as they are done, so memory use doesn't grow with number.
+        Yields the ionisations and cells of each block. The events are the same as those of
+        simulate for the same seed. With start the first start events are skipped, as when
+        resuming an earlier simulation with the same seed.'''
+        seeds = self._event_seeds(number, seed)
+        iterations = []
+        for first in range(start, number, block):
+            ionisations, ions_layers, iters = self._run_events(particle, std, seeds[first:first+block],
+                                                               sparse, lateral)
+            iterations.extend(iters)
+            self._record_iterations(iterations)
+            yield ionisations, ions_layers
 
-        ionisations = np.zeros(numlayers)
-        ions_layers = np.zeros((numlayers, numcells, numcells))
+    def simulate_again(self, particle, std, seed, index, lateral=True):
+        '''Simulate only event index of simulate with the given master seed, for example the
+        seed kept by an earlier call. Returns its ionisations and cells, the same as those
+        of that event in simulate. Not for the batch engine, whose events depend on the
+        other events of their batch.'''
+        if self._engine == 'batch':
+            raise ValueError('Single events of the batch engine can not be simulated again')
+        ionisations, ions_layers, iterations = self._run_events(particle, std, [rng.event_seed(seed, index)],
+                                                                lateral=lateral)
+        self._record_iterations(iterations)
+        return ionisations[0], None if ions_layers is None else ions_layers[0]
 
-        for part in particles_list:
+    def simulate_batch(self, particles, std, seed=None, sparse=False, lateral=True):
+        '''Simulate one event for each particle in particles, which can differ in energy and
+        entry point, transporting all of them together as one population tagged by event.
+        Returns the ionisations and cells of the events as simulate does. The events share
+        one random stream seeded with seed, so they are reproducible as a batch but differ
+        from the same events simulated one by one. Works for every engine.
 
-            particles = [copy.copy(part)]
-            iter = 0
-            while iter < 1000:
-                next = []
-                for p in particles:
-                    newparticles = self._calorimeter.step(p, std, 0.1)
-                    next.extend(newparticles)
-                particles = next
-                iter += 1
+        This is what the 'batch' engine does with the events of each call of simulate or each
+        block of simulate_blocks, so with it the result of a seed also depends on how the
+        events are divided up. For that reason the batch engine refuses workers > 1 and
+        simulate_again.'''
+        ionisations, ions_layers, iterations = self._run_batch(list(particles), std, seed, sparse, lateral)
+        self._record_iterations(iterations)
+        return ionisations, ions_layers
 
-            new_ions = self._calorimeter.ionisations()
-            ionisations = np.add(ionisations, new_ions)
+    def simulate_event(self, particles, std):
+        '''Simulate a single event with several incoming particles, all transported together
+        in one pass. Returns the ionisation in the layers and the cells as for one run of
+        simulate, together with the cells split by the incoming particle whose shower
+        deposited them, an array (particles, layers, cells, cells), which top_contributors
+        reduces to the main contributors of each cell. Only for the step, stack and freepath
+        engines.'''
+        if self._engine not in ('step', 'stack', 'freepath'):
+            raise ValueError(f'Deposits per incoming particle are not recorded by the {self._engine} engine')
+        cal = self._calorimeter
+        primaries = []
+        for i, particle in enumerate(particles):
+            primary = copy.copy(particle)
+            primary.primary = i
+            primaries.append(primary)
 
-            new_ionsbylayers = self._calorimeter.ions_by_layer()
-            ions_layers = np.add(ions_layers, new_ionsbylayers)
+        cal.track_primaries(len(primaries))
+        cal.reset()
+        try:
+            self._record_iterations([(self._transport(primaries, std), self._peak, self._moved)])
+            return cal.ionisations(), cal.ions_by_layer(), cal.ions_by_primary()
+        finally:
+            cal.track_primaries(0)
 
+    def simulate_multiple(self, particles_list, std, numlayers=None, numcells=None):
+        '''Simulate the particles in particles_list as one event and return the ionisation
+        in the layers and the cells of all of them together, see simulate_event.'''
+        ionisations, ions_layers, _ = self.simulate_event(particles_list, std)
         return ionisations, ions_layers
@@ -0,0 +1,85 @@
+import numpy as np
+
+
+class SparseHits:
+    '''Deposits of many runs stored as coordinates (COO format). Each nonzero deposit is
+    kept as its run, layer, flat cell index and value, so memory scales with the number of
+    occupied cells rather than with the size of the grid. The full grid has the given shape
+    (runs, layers, ...) where all axes after the layer axis are the cells. Indexing with a
+    run, a slice or an array of runs returns the dense deposits of just those runs.'''
+
+    def __init__(self, shape, run, layer, cell, deposit):
+        order = np.argsort(run, kind='stable')
+        self.shape = tuple(int(s) for s in shape)
+        self.run = np.asarray(run, dtype=np.int64)[order]
+        self.layer = np.asarray(layer, dtype=np.int64)[order]
+        self.cell = np.asarray(cell, dtype=np.int64)[order]
+        self.deposit = np.asarray(deposit)[order]
+
+    @classmethod
+    def from_dense(cls, dense):
+        '''Build from a dense array with runs along the first axis and layers along the second.'''
+        dense = np.asarray(dense)
+        flat = dense.reshape(dense.shape[0], dense.shape[1], -1)
+        run, layer, cell = np.nonzero(flat)
+        return cls(dense.shape, run, layer, cell, flat[run, layer, cell])
+
+    @classmethod
+    def concatenate(cls, parts, shape=None):
+        '''Join several SparseHits along the run axis. shape gives the shape of a single
+        run, which is only needed if parts is empty.'''
+        parts = list(parts)
+        if not parts:
+            return cls((0,) + tuple(shape), [], [], [], [])
+        offsets = np.cumsum([0] + [len(p) for p in parts])
+        shape = (int(offsets[-1]),) + parts[0].shape[1:]
+        return cls(shape,
+                   np.concatenate([p.run + o for p, o in zip(parts, offsets)]),
+                   np.concatenate([p.layer for p in parts]),
+                   np.concatenate([p.cell for p in parts]),
+                   np.concatenate([p.deposit for p in parts]))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        runs = np.arange(self.shape[0])[key]
+        single = np.ndim(runs) == 0
+        runs = np.atleast_1d(runs)
+
+        out = np.zeros((len(runs), self.shape[1], int(np.prod(self.shape[2:]))), dtype=self.deposit.dtype)
+        starts = np.searchsorted(self.run, runs, side='left')
+        ends = np.searchsorted(self.run, runs, side='right')
+        for i, (a, b) in enumerate(zip(starts, ends)):
+            out[i, self.layer[a:b], self.cell[a:b]] = self.deposit[a:b]
+        out = out.reshape((len(runs),) + self.shape[1:])
+
+        if single:
+            return out[0][rest]
+        return out[(slice(None),) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.todense()
+        return dense if dtype is None else dense.astype(dtype)
+
+    def todense(self):
+        '''The deposits of all runs as a dense array.'''
+        return self[:]
+
+    def to_hdf5(self, group, dtype='f'):
+        '''Write the coordinates and deposits as datasets in an HDF5 group.'''
+        group.attrs['format'] = 'coo'
+        group.attrs['shape'] = self.shape
+        group.create_dataset('run', data=self.run)
+        group.create_dataset('layer', data=self.layer)
+        group.create_dataset('cell', data=self.cell)
+        group.create_dataset('deposit', dtype=dtype, data=self.deposit)
+
+    @classmethod
+    def from_hdf5(cls, group):
+        '''Read back hits written with to_hdf5. Nothing is densified until it is indexed.'''
+        return cls(group.attrs['shape'], group['run'][:], group['layer'][:],
+                   group['cell'][:], group['deposit'][:])
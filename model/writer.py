@@ -0,0 +1,109 @@
+import os
+import h5py
+import numpy as np
+from .sparse import SparseHits
+
+
+class HitWriter:
+    '''Writes the cells of simulated events to "dataset_1" of an HDF5 file while the
+    simulation proceeds. Blocks of events are appended to a resizable, chunked dataset
+    (or to the coordinate datasets of SparseHits when sparse), so only one block has to be
+    held in memory. The file attributes runs_requested and runs_done record the progress,
+    and the file is flushed after every block so a crash keeps all finished events.
+
+    With resume an existing file written with the same number of requested runs, seed and
+    layout is opened to append to, after dropping any partly written block. runs_done then
+    tells how many events are already there.'''
+
+    def __init__(self, filename, shape, requested, sparse=False, compression=None, dtype='f',
+                 seed=None, resume=False):
+        self._shape = tuple(shape)
+        self._sparse = sparse
+        seed = '' if seed is None else repr((seed.entropy, seed.spawn_key))
+
+        if resume and os.path.exists(filename):
+            self._file = h5py.File(filename, 'a')
+            self._check(requested, seed)
+            self._truncate()
+            return
+
+        self._file = h5py.File(filename, 'w')
+        self._file.attrs['runs_requested'] = requested
+        self._file.attrs['runs_done'] = 0
+        self._file.attrs['entries_done'] = 0
+        self._file.attrs['seed'] = seed
+
+        if sparse:
+            self._group = self._file.create_group('dataset_1')
+            self._group.attrs['format'] = 'coo'
+            self._group.attrs['shape'] = (0,) + self._shape
+            for name in ('run', 'layer', 'cell', 'deposit'):
+                self._group.create_dataset(name, shape=(0,), maxshape=(None,), chunks=True,
+                                           compression=compression,
+                                           dtype=dtype if name == 'deposit' else np.int64)
+        else:
+            self._dataset = self._file.create_dataset('dataset_1', shape=(0,) + self._shape,
+                                                      maxshape=(None,) + self._shape,
+                                                      chunks=(1,) + self._shape,
+                                                      compression=compression, dtype=dtype)
+
+    def _check(self, requested, seed):
+        '''Make sure an existing file was started with the same settings before resuming it.'''
+        attrs = self._file.attrs
+        data = self._file['dataset_1']
+        sparse = isinstance(data, h5py.Group)
+        shape = tuple(data.attrs['shape'][1:]) if sparse else data.shape[1:]
+        if (attrs['runs_requested'] != requested or attrs['seed'] != seed or
+                sparse != self._sparse or shape != self._shape):
+            self._file.close()
+            raise ValueError(f'Cannot resume {self._file.filename}, it was written with other settings')
+        if sparse:
+            self._group = data
+        else:
+            self._dataset = data
+
+    def _truncate(self):
+        '''Drop anything written after the last complete block, e.g. by a job killed halfway
+        through an append.'''
+        if self._sparse:
+            for name in ('run', 'layer', 'cell', 'deposit'):
+                self._group[name].resize((int(self._file.attrs['entries_done']),))
+            self._group.attrs['shape'] = (self.runs_done,) + self._shape
+        else:
+            self._dataset.resize((self.runs_done,) + self._shape)
+
+    @property
+    def runs_done(self):
+        return int(self._file.attrs['runs_done'])
+
+    def _append(self, dataset, values):
+        n = dataset.shape[0]
+        dataset.resize((n + len(values),) + dataset.shape[1:])
+        dataset[n:] = values
+
+    def append(self, block):
+        '''Append a block of events, either a dense array with the events along the first
+        axis or SparseHits.'''
+        done = self.runs_done
+        if self._sparse:
+            if not isinstance(block, SparseHits):
+                block = SparseHits.from_dense(block)
+            self._append(self._group['run'], block.run + done)
+            self._append(self._group['layer'], block.layer)
+            self._append(self._group['cell'], block.cell)
+            self._append(self._group['deposit'], block.deposit)
+            self._group.attrs['shape'] = (done + len(block),) + self._shape
+            self._file.attrs['entries_done'] = self._group['run'].shape[0]
+        else:
+            self._append(self._dataset, np.asarray(block))
+        self._file.attrs['runs_done'] = done + len(block)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
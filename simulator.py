@@ -1,8 +1,8 @@
 import numpy as np
 import model
-import h5py
-import pickle
 import time
+from model.campaign import run_campaign
+from model.cache import ResultCache
 
 # Layer properties
 print("* Initialising calorimeter *")
@@ -20,54 +20,30 @@ mycal = model.Calorimeter()
 for i in range(num_layers):
     mycal.add_layers([passive, active])
     
-counts_all_runs = []
 en1 = np.array([0.1])
 en2 = np.arange(2.0, 42.0, 2.0)
 energies = np.append(en1, en2)
 direct = "simulations/single_hits/"
 
-energies_dict = {}
-
 # some predefined particle properties
 sigma = 0.3; num_runs = 10; x = 0; y = 0
+# store only the occupied cells in the data files
+sparse = False
+# continue a killed campaign from its checkpoint in direct
+resume = False
+# master seed of the campaign, None draws a new one
+seed = None
+# directory to keep the results in and reuse them when the same settings and seed are
+# simulated again, None for no cache
+cache = None
 
-for energy in energies:
-
-    # Define calorimeter
-    mycal.reset()    
-    print("* Initialising incident particle *")
-    
-    # particle properties
-    electron = model.Electron(0.0, x, y, energy, 0, 0)
-    
-    print("Energy: ", energy)
+if __name__ == '__main__':
     print("* ...SIMULATING... *")
-    # Run simulation
-    sim = model.Simulation(mycal)
     tic = time.time()
-    # counts by layer
-    _ , counts_layers_run = sim.simulate(electron, sigma, num_runs)
+    # Blocks of runs of all energy points are spread over all cores, most expensive first
+    energies_dict = run_campaign(mycal, energies, num_runs, direct, sigma=sigma, x=x, y=y,
+                                 seed=seed, sparse=sparse, resume=resume,
+                                 cache=None if cache is None else ResultCache(cache))
     toc = time.time()
-    
-    nested_dict = {"Energy": energy, "num_runs": num_runs,
-                  "enterx": x, "entery": y, "sigma": sigma, "time_taken": toc-tic}
-    energies_dict[str(energy)] = nested_dict
-    
     print("* SIMULATION DONE! *")
     print("That took " + str(toc-tic) + " seconds")
-    
-    # Define directory
-    data_filename = '%.1fGeV_%iruns_data.h5' %(energy,num_runs)
-    data_directory = direct + data_filename
-    
-    # Save data from every run  
-    f = h5py.File(data_directory, "w")
-    f.create_dataset('dataset_1', dtype='f', data=counts_layers_run)
-    f.close()
-    print("* Data saved! *")
-    
-    dict_filename = '%.1fGeV_%iruns_dict.p' %(energy,num_runs)
-    dict_direct = direct + dict_filename
-    with open(dict_direct, 'wb') as handle:
-        pickle.dump(energies_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
-    print('* Dictionary saved! *')
\ No newline at end of file
@@ -9,6 +9,9 @@ en2 = np.array([32.0])
 energies = np.append(en1, en2)
 num_runs = 500
 simulations_folder = 'simulations/single_hits/'
+# seed of the shuffles and positions of the second cluster
+seed = 1
+generator = np.random.default_rng(seed)
 
 cents = []
 for en1 in energies:
@@ -27,8 +30,7 @@ for en1 in energies:
         en2_images = get_images_single_hit(simulations_folder, en2, num_runs, add_noise=False)
 
         if en1 == en2:
-            random_mask = np.arange(num_runs)
-            np.random.shuffle(random_mask)
+            random_mask = generator.permutation(num_runs)
             en2_images = en2_images[random_mask]
 
         # For every run corresponding to both energies, sum corresponding layers and cells
@@ -56,7 +58,7 @@ for en1 in energies:
             # Second cluster --> select random values for center within region
 #                 centx2 = np.random.randint(low=-4, high=4, size=1)[0]
 #                 centy2 = np.random.randint(low=-4, high=4, size=1)[0]
-            theta = np.random.randint(low=0, high=360, size=1)[0]
+            theta = generator.integers(low=0, high=360)
             theta = theta * np.pi/180
             centx2 = np.round(r*np.cos(theta))
             centy2 = np.round(r*np.sin(theta))
@@ -85,8 +87,7 @@ for en1 in energies:
                 r += 1
         
         # randomly shuffle multiple images and labels
-        random_mask2 = np.arange(num_runs)
-        np.random.shuffle(random_mask2)
+        random_mask2 = generator.permutation(num_runs)
         multiple_images = multiple_images[random_mask2]
         multiple_labels = multiple_labels[random_mask2]
     
@@ -1,21 +1,52 @@
 import numpy as np
-from utils.training_utils import get_images_single_hit, get_labels_single_hit, add_noise_naive
+from utils.training_utils import get_images_single_hit, get_labels_single_hit, add_noise_naive, read_hits
+from model import Electron, rng
+from model.sparse import SparseHits
 import pickle
 import h5py
 
 
-def save_multiple_hits(direct, name, images, labels, run_dict):
+def write_hits(filename, data, sparse=False):
+    '''Write data to "dataset_1" of an HDF5 file, either dense or as SparseHits that only
+    hold the occupied cells.'''
+    f = h5py.File(filename, "w")
+    if sparse:
+        if not isinstance(data, SparseHits):
+            data = SparseHits.from_dense(data)
+        data.to_hdf5(f.create_group('dataset_1'))
+    else:
+        f.create_dataset('dataset_1', dtype='f', data=data)
+    f.close()
+
+
+def simulate_multiple_hits(simulation, hits, std, num_runs, seed=None):
+    '''Simulate num_runs events in which electrons enter together at the (x, y, energy)
+    of each entry in hits. Returns the summed images (runs, layers, cells, cells, 1), the
+    images of each electron (runs, hits, layers, cells, cells, 1) and for every cell the
+    fraction of its ionisation from each electron, so no overlay of single hits is needed.'''
+    particles = [Electron(0.0, x, y, energy, 0, 0) for x, y, energy in hits]
+    images = []
+    truth = []
+    for s in np.random.SeedSequence(seed).spawn(num_runs):
+        rng.seed(s)
+        _, cells, by_primary = simulation.simulate_event(particles, std)
+        images.append(cells)
+        truth.append(by_primary)
+    images = np.expand_dims(np.array(images), axis=-1)
+    truth = np.expand_dims(np.array(truth), axis=-1)
+    total = images[:, np.newaxis]
+    fractions = np.divide(truth, total, out=np.zeros_like(truth), where=total > 0)
+    return images, truth, fractions
+
+
+def save_multiple_hits(direct, name, images, labels, run_dict, sparse=False):
 
     imgs_directory = direct + name + "_images.h5"
-    f = h5py.File(imgs_directory, "w")
-    f.create_dataset('dataset_1', dtype='f', data=images)
-    f.close()
+    write_hits(imgs_directory, images, sparse)
     print("* Data saved! *")
 
     labels_directory = direct + name + "_labels.h5"
-    f2 = h5py.File(labels_directory, "w")
-    f2.create_dataset('dataset_1', dtype='f', data=labels)
-    f2.close()
+    write_hits(labels_directory, labels, sparse)
     print("* Labels saved! *")
 
     dict_direct = direct + name + "_dict.p"
@@ -29,7 +60,7 @@ def read_multiple_hits(direct, name, num_runs=500, img_size=48, add_noise=False,
     images = None
     if read_images is True:
         imgs_directory = direct + name + "_images.h5"
-        images = h5py.File(imgs_directory, 'r')['dataset_1'][:]
+        images = read_hits(imgs_directory)[:]
         if add_noise is True:
             images = add_noise_naive(images, noise)
         if img_size == 48:
@@ -38,7 +69,7 @@ def read_multiple_hits(direct, name, num_runs=500, img_size=48, add_noise=False,
     labels = None
     if predict is False:
         labels_directory = direct + name + "_labels.h5"
-        labels = h5py.File(labels_directory, 'r')['dataset_1'][:]
+        labels = read_hits(labels_directory)[:]
         if img_size == 48:
             labels = labels[:, :, 8:56, 8:56, :]
     
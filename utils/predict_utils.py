@@ -74,4 +74,17 @@ def share_energy(total_images, first_preds, second_preds, thres1=0.9, thres2=0.1
                         
     return p1_counts, p2_counts
 
-    
\ No newline at end of file
+
+def share_energy_truth(total_images, fractions, first_layer=0):
+    '''Share the counts of total_images between the particles with the true fractions from
+    utils.multiple_hits_utils.simulate_multiple_hits. Both are expected in the layout that
+    function returns, total_images (runs, layers, cells, cells, 1) and fractions (runs,
+    hits, layers, cells, cells, 1), with only the real layers of the calorimeter and cropped
+    alike if at all. Layers before first_layer are left out, use first_layer=2 for images
+    with the two entry point layers of the training data in front. Returns the counts of
+    each particle as (runs, layers, cells*cells), the layout of share_energy for 48x48
+    images with the entry layers dropped, so the two can be compared directly.'''
+    num_runs, num_hits = fractions.shape[:2]
+    counts = total_images[:, np.newaxis, first_layer:, :, :, 0]*fractions[:, :, first_layer:, :, :, 0]
+    counts = counts.reshape(num_runs, num_hits, counts.shape[2], -1)
+    return tuple(counts[:, i] for i in range(num_hits))
@@ -3,6 +3,7 @@ import numpy as np
 import h5py
 import pickle
 import os
+from model.sparse import SparseHits
 
 def add_noise_naive(images, noise=0.02):
     
@@ -73,6 +74,21 @@ def add_noise_naive_raw(images, noise=0.02):
 
 
 
+def read_hits(f):
+    
+    """
+    Open "dataset_1" of a data file without reading it. Dense files give
+    the HDF5 dataset, sparse files give SparseHits. Both are only
+    densified for the runs that are indexed.
+    """
+    
+    data = h5py.File(f, 'r')['dataset_1']
+    if isinstance(data, h5py.Group):
+        data = SparseHits.from_hdf5(data)
+    return data
+
+
+
 def get_images_single_hit(direct, energy, num_runs, add_noise = True, noise=0.02):
     
     """
@@ -87,7 +103,7 @@ def get_images_single_hit(direct, energy, num_runs, add_noise = True, noise=0.02
 
     file = '%.1fGeV_%iruns_data.h5' %(energy, num_runs)
     f = direct + file
-    data_runs = h5py.File(f, 'r')['dataset_1'][:]
+    data_runs = read_hits(f)
     
     # Define the entry label, just one in the center
     entry = np.zeros((32, 32))
@@ -127,7 +143,7 @@ def get_labels_single_hit(direct, energy, num_runs):
 
     file = '%.1fGeV_%iruns_data.h5' %(energy, num_runs)
     f = direct + file
-    data_runs = h5py.File(f, 'r')['dataset_1'][:]
+    data_runs = read_hits(f)
 
     entry = np.zeros((32, 32))
     entry[16, 16] = 1
@@ -162,7 +178,7 @@ def get_images_single_hit_raw(direct, energy, num_runs, add_noise = True, noise=
 
     file = '%.1fGeV_%iruns_data.h5' %(energy, num_runs)
     f = direct + file
-    new_data_runs = h5py.File(f, 'r')['dataset_1'][:]
+    new_data_runs = read_hits(f)[:]
         
     new_data_runs = np.expand_dims(new_data_runs, axis=-1)
     if add_noise is True:
@@ -181,7 +197,7 @@ def get_labels_single_hit_raw(direct, energy, num_runs):
 
     file = '%.1fGeV_%iruns_data.h5' %(energy, num_runs)
     f = direct + file
-    new_data_runs = h5py.File(f, 'r')['dataset_1'][:]
+    new_data_runs = read_hits(f)[:]
     new_data_runs[new_data_runs > 0] = 1
     new_data_runs = np.expand_dims(new_data_runs, axis=-1)
 
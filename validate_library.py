@@ -0,0 +1,62 @@
+import time
+import numpy as np
+import model
+
+# Same calorimeter as simulator.py
+passive = model.Layer('lead', 1, 1, 1.0, 1, 0.0)
+active = model.Layer('scin', 0.01, 1, 32, 32, 1.0)
+mycal = model.Calorimeter()
+for i in range(30):
+    mycal.add_layers([passive, active])
+
+energy = 2.0
+sigma = 0.3; num_runs = 400
+threshold = 0.5; entries = 5
+# Largest allowed difference of the means and spreads, in standard errors
+limit = 3.0
+
+
+def profile(cells):
+    '''Centroid in x and y and the width in x of the cells of each run, summed over the
+    layers, in units of cells.'''
+    grid = cells.sum(1)
+    total = grid.sum((1, 2))
+    index = np.arange(grid.shape[-1])
+    x = (grid.sum(1)*index).sum(1)/total
+    y = (grid.sum(2)*index).sum(1)/total
+    width = np.sqrt((grid.sum(1)*(index - x[:, None])**2).sum(1)/total)
+    return np.stack((x, y, width), axis=1)
+
+
+def check(name, values, allowed=0):
+    '''Print the largest of the pulls values and whether more than allowed are beyond limit.'''
+    values = np.abs(np.atleast_1d(values))
+    failed = (values > limit).sum() > allowed
+    print(f'{name:24} largest difference {values.max():5.1f} standard errors'
+          f'{"  FAILED" if failed else ""}')
+    return failed
+
+
+if __name__ == '__main__':
+    tic = time.time()
+    library = model.ShowerLibrary.build(mycal, sigma, threshold, entries=entries, seed=1)
+    print(f'Library built in {time.time() - tic:.1f} s')
+    particle = model.Electron(0.0, 0, 0, energy, 0, 0)
+    full, full_cells = model.Simulation(mycal).simulate(particle, sigma, num_runs, seed=2)
+    fast, fast_cells = model.Simulation(mycal, library=library).simulate(particle, sigma, num_runs,
+                                                                         seed=2)
+    print(model.validation_report(full, fast, names=('full', 'library')))
+    full_profile, fast_profile = profile(full_cells), profile(fast_cells)
+    print('centroid x, y and width: full ' + ' '.join(f'{v:.2f}' for v in full_profile.mean(0)) +
+          ', library ' + ' '.join(f'{v:.2f}' for v in fast_profile.mean(0)))
+
+    total = full.sum(1)[:, None], fast.sum(1)[:, None]
+    # With many layers a few beyond limit are expected by chance
+    allowed = int(0.05*full.shape[1]) + 1
+    failed = [check('total mean', model.mean_pulls(*total)),
+              check('total spread', model.spread_pulls(*total)),
+              check('layer means', model.mean_pulls(full, fast), allowed),
+              check('layer spreads', model.spread_pulls(full, fast), allowed),
+              check('centroid and width', model.mean_pulls(full_profile, fast_profile))]
+    if any(failed):
+        raise SystemExit('The library does not reproduce the full simulation')
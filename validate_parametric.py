@@ -0,0 +1,36 @@
+import time
+import model
+
+# Same calorimeter as simulator.py
+passive = model.Layer('lead', 1, 1, 1.0, 1, 0.0)
+active = model.Layer('scin', 0.01, 1, 32, 32, 1.0)
+mycal = model.Calorimeter()
+for i in range(30):
+    mycal.add_layers([passive, active])
+
+sigma = 0.3
+fit_energies = [1.0, 2.0, 4.0]; fit_runs = 1000
+# A fitted energy and one interpolated between two fitted ones
+energies = [2.0, 3.0]; num_runs = 500; fast_runs = 5000
+# Largest allowed difference of the means and spreads, in standard errors
+limit = 3.0
+
+
+if __name__ == '__main__':
+    sim = model.Simulation(mycal)
+    tic = time.time()
+    parametric = model.ParametricSimulation.from_simulation(sim, fit_energies, sigma, fit_runs, seed=1)
+    print(f'Parametric simulation fitted in {time.time() - tic:.1f} s')
+
+    failed = False
+    for i, energy in enumerate(energies):
+        particle = model.Electron(0.0, 0, 0, energy, 0, 0)
+        full, _ = sim.simulate(particle, sigma, num_runs, seed=2 + i)
+        fast, _ = parametric.simulate(particle, sigma, fast_runs, seed=2 + i)
+        print(f'* {energy} GeV *')
+        print(model.validation_report(full, fast, names=('full', 'param')))
+        for failure in model.validation_failures(full, fast, limit):
+            print('FAILED ' + failure)
+            failed = True
+    if failed:
+        raise SystemExit('The parametric simulation does not reproduce the full simulation')